@@ -1,11 +1,36 @@
+import os
 import sqlite3
+import numpy as np
 from sites_scraper import *
 from data_api import *
+from geo import load_site_coords, haversine_matrix
+from profiling import timed
+from regions import default_region
 
 db_str_delimiter = "!#!"
 
+# all-pairs site distances, precomputed at ingest (see save_distance_matrix(.))
+distances_name = "Distances"
+create_distances = """
+CREATE TABLE IF NOT EXISTS {name} (
+    Names TEXT NOT NULL,
+    Matrix BLOB NOT NULL
+)
+""".format
 
-def schema(db_filename="MichiganTouristSites.sqlite"):
+# page views per site and day (see record_visit(.)); kept when the catalog is re-scraped
+create_site_visits = """
+CREATE TABLE IF NOT EXISTS SiteVisits (
+    Name TEXT NOT NULL,
+    Day TEXT NOT NULL,
+    Count INTEGER NOT NULL DEFAULT 0,
+
+    PRIMARY KEY (Name, Day)
+)
+"""
+
+
+def schema(db_filename=default_region.db_filename):
     """
     Creates database.
 
@@ -67,10 +92,218 @@ def schema(db_filename="MichiganTouristSites.sqlite"):
     """.format
     cur.execute(create_map(name=maps_name))
     conn.commit()
+
+    cur.execute(drop_table(name=distances_name))
+    conn.commit()
+    cur.execute(create_distances(name=distances_name))
+    conn.commit()
+
+    cur.execute(create_site_visits)
+    conn.commit()
+    conn.close()
+
+
+def save_distance_matrix(db_filename=default_region.db_filename):
+    """
+    Precomputes the great-circle distances (km) between all geocoded sites and stores them as a single row holding
+    the site names and a float32 matrix in row-major order.
+
+    Parameters
+    ----------
+    db_filename: str
+        Database filename.
+
+    Returns
+    -------
+    list, np.ndarray
+        Site names and the distance matrix of shape (N, N) in the same order.
+    """
+    names, _, coords = load_site_coords(db_filename)
+    dist = haversine_matrix(coords, coords).astype(np.float32)
+
+    conn = sqlite3.connect(db_filename)
+    cur = conn.cursor()
+    cur.execute(create_distances(name=distances_name))
+    cur.execute(f"DELETE FROM {distances_name}")
+    cur.execute(f"INSERT INTO {distances_name}(Names, Matrix) VALUES (?, ?)",
+                [db_str_delimiter.join(names), dist.tobytes()])
+    conn.commit()
+    conn.close()
+
+    return names, dist
+
+
+def load_distance_matrix(db_filename=default_region.db_filename):
+    """
+    Loads the matrix stored by save_distance_matrix(.), computing it first if the DB predates it.
+
+    Parameters
+    ----------
+    db_filename: str
+        Database filename.
+
+    Returns
+    -------
+    list, np.ndarray
+        Site names and the float32 distance matrix of shape (N, N) in the same order.
+    """
+    conn = sqlite3.connect(db_filename)
+    cur = conn.cursor()
+    try:
+        cur.execute(f"SELECT Names, Matrix FROM {distances_name}")
+        record = cur.fetchone()
+    except sqlite3.OperationalError:
+        record = None
     conn.close()
 
+    if record is None:
+        return save_distance_matrix(db_filename)
 
-def load_from_db(name, db_filename="MichiganTouristSites.sqlite"):
+    names = record[0].split(db_str_delimiter) if record[0] != "" else []
+    dist = np.frombuffer(record[1], dtype=np.float32).reshape(len(names), len(names))
+
+    return names, dist
+
+
+def init_db(db_filename=default_region.db_filename, cache_scraper="cache_scraper.json", cache_map="cache_map.json",
+            region=default_region):
+    """
+    Scrapes all tourist sites of "region" and stores them into a new database, unless "db_filename" already exists.
+    Must run once before the server forks its workers.
+
+    Parameters
+    ----------
+    db_filename: str
+        Database filename.
+    cache_scraper: str
+        Cache file for scraping.
+    cache_map: str
+        Cache file for MapQuest queries.
+    region: Region
+        Region to scrape.
+
+    Returns
+    -------
+    None
+    """
+    if os.path.exists(db_filename):
+        print("Found database")
+        # databases created before visits were counted
+        conn = sqlite3.connect(db_filename)
+        conn.execute(create_site_visits)
+        conn.commit()
+        conn.close()
+        return
+
+    # create DB
+    schema(db_filename)
+
+    print("Initializing database...")
+    detail_urls = scrape_main_page(cache_scraper, region)
+    for name, site_url in detail_urls.items():
+        sites_on_page = scrape_site(site_url, cache_scraper)
+        for site_key, site in sites_on_page.items():
+            print(f"current: {site_key}")
+            print("-" * 30)
+            tourist_site = TouristSite(**site, region=region)
+            try:
+                tourist_site.save_to_db(cache_map, db_filename=db_filename)
+            except sqlite3.IntegrityError as e:
+                print(f"###duplicate: {site_key}###")
+                print("#" * 30)
+
+    save_distance_matrix(db_filename)
+    print("Done!")
+
+
+def init_region(region):
+    """
+    init_db(.) with the region's database and cache files.
+
+    Parameters
+    ----------
+    region: Region
+        Region to initialize.
+
+    Returns
+    -------
+    None
+    """
+    print(f"Region {region.code}:")
+    init_db(region.db_filename, region.cache_filename("scraper"), region.cache_filename("map"), region)
+
+
+def record_visit(name, db_filename=default_region.db_filename, timeout=0.1):
+    """
+    Counts a page view of a tourist site for today (UTC). Used to rank sites by recent popularity. Best effort: if
+    the DB is busy for longer than "timeout" seconds, the view is not counted.
+
+    Parameters
+    ----------
+    name: str
+        Place name.
+    db_filename: str
+        Database filename.
+    timeout: float
+        Maximal time to wait for the DB write lock, in seconds.
+
+    Returns
+    -------
+    None
+    """
+    conn = sqlite3.connect(db_filename, timeout=timeout)
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            INSERT INTO SiteVisits(Name, Day, Count) VALUES (?, DATE('now'), 1)
+            ON CONFLICT(Name, Day) DO UPDATE SET Count = Count + 1
+        """, [name])
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        # a busy DB must not break page rendering
+        print(f"could not record visit: {e}")
+    conn.close()
+
+
+def load_site_names_by_popularity(days=7, db_filename=default_region.db_filename):
+    """
+    All tourist site names, most visited in the last "days" days first, the rest in catalog order.
+
+    Parameters
+    ----------
+    days: int
+        Length of the popularity window.
+    db_filename: str
+        Database filename.
+
+    Returns
+    -------
+    list
+        Site names.
+    """
+    conn = sqlite3.connect(db_filename)
+    cur = conn.cursor()
+    cur.execute(create_site_visits)
+    conn.commit()
+    q = """
+    SELECT T.Name
+    FROM TouristSites T LEFT JOIN (
+        SELECT Name, SUM(Count) AS Visits
+        FROM SiteVisits
+        WHERE Day >= DATE('now', ?)
+        GROUP BY Name
+    ) V ON T.Name = V.Name
+    ORDER BY COALESCE(V.Visits, 0) DESC, T.Id
+    """
+    cur.execute(q, [f"-{int(days)} days"])
+    names = [record[0] for record in cur.fetchall()]
+    conn.close()
+
+    return names
+
+
+@timed("db")
+def load_from_db(name, db_filename=default_region.db_filename, region=default_region):
     """
     Create a TouristSite by querying the DB by "name". Used for rendering a detail page when a user clicks on the link
     on index.html.
@@ -81,6 +314,8 @@ def load_from_db(name, db_filename="MichiganTouristSites.sqlite"):
         Place name.
     db_filename: str
         Database filename.
+    region: Region
+        Region of the place.
 
     Returns
     -------
@@ -99,7 +334,7 @@ def load_from_db(name, db_filename="MichiganTouristSites.sqlite"):
     for record in cur.fetchall():
         record_tuple = record
         break
-    tourist_site = TouristSite()
+    tourist_site = TouristSite(region=region)
     tourist_site.name = record_tuple[0]
     tourist_site.photo_url = record_tuple[1]
     tourist_site.desc = record_tuple[2].split(db_str_delimiter)
@@ -128,14 +363,17 @@ class TouristSite(object):
         List of str. URL of additional information if available. Default: [].
     lon, lat: float
         Longitude and Latitude. Only available by loading from DB.
+    region: Region
+        Region the tourist site belongs to. Default: default region.
     """
-    def __init__(self, name=None, photo_url=None, desc=None, address=None, info_url=None):
+    def __init__(self, name=None, photo_url=None, desc=None, address=None, info_url=None, region=None):
         self.name = name
         self.photo_url = photo_url
         self.desc = desc
         self.address = address
         self.info_url = info_url
         self.lon, self.lat = None, None
+        self.region = default_region if region is None else region
 
     def __repr__(self):
         # only prints first 10 words of the description
@@ -157,7 +395,7 @@ class TouristSite(object):
         dict
             See documentation of data_api.get_twitter_data(.).
         """
-        return get_twitter_data(self.name, cache_filename)
+        return get_twitter_data(self.name, cache_filename, region=self.region)
 
     def get_map(self, cache_filename):
         """
@@ -171,14 +409,17 @@ class TouristSite(object):
         Returns
         -------
         dict
-            See documentation of data_api.get_map_data(.).
+            See documentation of data_api.get_map_data(.); empty if the MapQuest rate limit is exhausted.
         """
-        if self.address is not None:
-            return get_map_data(self.address, cache_filename)
+        try:
+            if self.address is not None:
+                return get_map_data(self.address, cache_filename, self.region)
 
-        return get_map_data(self.name, cache_filename)
+            return get_map_data(self.name, cache_filename, self.region)
+        except RateLimited:
+            return dict()
 
-    def get_weather(self, cache_filename, db_filename="MichiganTouristSites.sqlite"):
+    def get_weather(self, cache_filename, db_filename=None):
         """
         A wrapper for data_api.get_weather_data(.).
 
@@ -187,13 +428,15 @@ class TouristSite(object):
         cache_filename: str
             Cache file to use.
         db_filename: str
-            Database filename.
+            Database filename. Default: the database of the site's region.
 
         Returns
         -------
         dict
             See documentation of data_api.get_weather_data(.).
         """
+        if db_filename is None:
+            db_filename = self.region.db_filename
         q = """
         SELECT Lng, Lat
         FROM TouristSites T JOIN Maps M ON T.Name = M.Name
@@ -212,7 +455,7 @@ class TouristSite(object):
 
         return get_weather_data(lat, lon, cache_filename)
 
-    def save_to_db(self, cache_map, db_filename="MichiganTouristSites.sqlite"):
+    def save_to_db(self, cache_map, db_filename=None):
         """
         Save instance data to database.
 
@@ -221,12 +464,14 @@ class TouristSite(object):
         cache_map: str
             Cache file for MapQuest queries.
         db_filename: str
-            Database filename.
+            Database filename. Default: the database of the site's region.
 
         Returns
         -------
         None
         """
+        if db_filename is None:
+            db_filename = self.region.db_filename
         conn = sqlite3.connect(db_filename)
         cur = conn.cursor()
         insert_tourist_sites = """
@@ -1,9 +1,15 @@
 import requests
 import json
+import os
+import time
 import secrets
+import numpy as np
 from requests_oauthlib import OAuth1
 from pprint import pprint
 from utilities import *
+from profiling import timed
+from regions import default_region
+from rate_limiter import limiters, update_from_headers, RateLimited, skipped_requests
 
 client_key = secrets.TWITTER_API_KEY
 client_secret = secrets.TWITTER_API_SECRET
@@ -21,6 +27,70 @@ map_box_key = secrets.MAPBOX_API_KEY
 
 open_weather_key = secrets.OPENWATHER_API_KEY
 
+# rate limiter bucket of each endpoint, see rate_limiter.quotas
+upstreams = {
+    "https://api.twitter.com/1.1/users/search.json": "twitter_users",
+    "https://api.twitter.com/1.1/search/tweets.json": "twitter_search",
+    "http://www.mapquestapi.com/geocoding/v1/address": "mapquest",
+    "https://community-open-weather-map.p.rapidapi.com/forecast": "openweather",
+}
+
+# params of each endpoint in the order the former construct_unique_key(.) joined them, for rekey_caches(.)
+legacy_key_params = {
+    "https://api.twitter.com/1.1/users/search.json": ["q", "count"],
+    "https://api.twitter.com/1.1/search/tweets.json": ["q", "tweet_mode", "count"],
+    "http://www.mapquestapi.com/geocoding/v1/address": ["key", "location", "maxResults"],
+    "https://community-open-weather-map.p.rapidapi.com/forecast": ["lat", "lon", "units"],
+}
+
+# forecasts are requested for coordinates rounded to this many decimals (0.1 deg ~ 11 km), so that nearby sites share
+# one cached forecast
+weather_grid_decimals = 1
+
+
+@timed("upstream")
+def rate_limited_get(baseurl, params, **kwargs):
+    """
+    GET request counted against the quota of the endpoint's upstream (see "upstreams"). Waits briefly for budget
+    (longer for background callers) and syncs the budget with the response's rate limit headers.
+
+    Parameters
+    ----------
+    baseurl: str
+        The URL for the API endpoint, a key of "upstreams".
+    params: dict
+        A dictionary of param:value pairs
+    kwargs:
+        Passed on to requests.get(.).
+
+    Returns
+    -------
+    dict or list
+        The JSON response.
+
+    Raises
+    ------
+    RateLimited
+        If the budget is used up, or the upstream answered with HTTP 429.
+    """
+    upstream = upstreams[baseurl]
+    skipped = skipped_requests.get()
+    if not limiters[upstream].acquire():
+        print(f"rate limited: {upstream}")
+        if skipped is not None:
+            skipped.append(upstream)
+        raise RateLimited(upstream)
+
+    resp = requests.get(baseurl, params=params, **kwargs)
+    update_from_headers(upstream, resp.headers, resp.status_code)
+    if resp.status_code == 429:
+        print(f"rate limited by upstream: {upstream}")
+        if skipped is not None:
+            skipped.append(upstream)
+        raise RateLimited(upstream)
+
+    return resp.json()
+
 
 def make_request(baseurl, params):
     """
@@ -39,11 +109,10 @@ def make_request(baseurl, params):
         the data returned from making the request in the form of
         a dictionary
     """
-    resp = requests.get(baseurl, params=params, auth=oauth)
-    return resp.json()
+    return rate_limited_get(baseurl, params, auth=oauth)
 
 
-def make_request_with_cache(baseurl, params, cache_filename, count=100):
+def make_request_with_cache(baseurl, params, cache_filename, count=100, fallback=None):
     """
     A general querying function with caching.
 
@@ -57,6 +126,8 @@ def make_request_with_cache(baseurl, params, cache_filename, count=100):
         Cache file to use.
     count: int
         Number of queries to return.
+    fallback: dict or list
+        Returned (and not cached) on a cache miss when the upstream's rate limit is exhausted. Default: None.
 
     Returns
     -------
@@ -72,72 +143,180 @@ def make_request_with_cache(baseurl, params, cache_filename, count=100):
         return cache[unique_key]
     else:
         print("making new request")
-        results = make_request(baseurl, params)
+        try:
+            results = make_request(baseurl, params)
+        except RateLimited:
+            return fallback
         cache[unique_key] = results
         save_cache(cache, cache_filename)
         return results
 
 
-def get_twitter_data(keywords, cache_filename):
+def get_twitter_data(keywords, cache_filename, max_tweets=100, refresh_interval=15 * 60, region=default_region):
     """
     Querying for Twitter data. Tries to get as many tweets about "keyword" and as accurately  as possible by
     experimenting sequentially different parameters. Returns a dictionary containing possible Twitter users with tweets
     at most one-week old (per Twitter API).
 
+    Tweets are kept in a per-site timeline (see "timeline_filename(.)"), deduplicated by tweet id and capped at the
+    "max_tweets" newest. At most every "refresh_interval" seconds, each query is re-run with "since_id" set to the
+    newest tweet it returned so far, so a refresh only transfers new tweets. A query skipped for lack of rate limit
+    budget is retried on the next call.
+
     Parameters
     ----------
     keywords: str
         Name of a tourist site.
     cache_filename: str
         Cache file to use.
+    max_tweets: int
+        Maximal number of tweets kept per site.
+    refresh_interval: float
+        Minimal time between refreshes of a site, in seconds.
+    region: Region
+        Region of the site; its name narrows down the user search.
 
     Returns
     -------
     dict
         In the form of
         {
-            "user 1": {"posting time 1": "tweet", "posting time 2": "tweet", ...}
-            "user 2": {...}
+            "user 1": [{"id": str, "created_at": str, "text": str}, ...]
+            "user 2": [...]
             ...
-            "queried by 'keywords'": {"posting time 1": "tweet", ...}
+            "keywords--'keywords'": [...]
         }
+        with each list sorted newest first. A tweet found by several queries is listed once, under the first one.
     """
     # retrieve relevant users
     user_baseurl = "https://api.twitter.com/1.1/users/search.json"
-    params = {"q": f"{keywords} Michigan"}
+    params = {"q": f"{keywords} {region.name}"}
     count = 3
     users_resp = make_request_with_cache(user_baseurl, params, cache_filename, count)
+    if users_resp is None:
+        return dict()  # rate limited: retry the region-qualified search on the next call
     if len(users_resp) == 0:
         params = {"q": f"{keywords}"}
         users_resp = make_request_with_cache(user_baseurl, params, cache_filename, count)
-        if len(users_resp) == 0:
+        if users_resp is None or len(users_resp) == 0:
             return dict()  # no likely Twitter account
 
+    groups = twitter_queries(keywords, users_resp)
+    timeline_file = timeline_filename(cache_filename)
+    timeline = open_cache(timeline_file).get(keywords, {"fetched_at": dict(), "since_ids": dict(), "tweets": []})
+    if not isinstance(timeline["fetched_at"], dict):
+        # timelines stored before queries were refreshed separately
+        timeline["fetched_at"] = dict()
+    stale = {q: group for q, group in groups.items()
+             if time.time() - timeline["fetched_at"].get(q, 0) >= refresh_interval}
+    if len(stale) > 0:
+        timeline = refresh_timeline(timeline, stale, max_tweets)
+        save_cache({keywords: timeline}, timeline_file)
+
+    output_dict = {group: [] for group in groups.values()}
+    for tweet in timeline["tweets"]:
+        if tweet["group"] in output_dict:
+            output_dict[tweet["group"]].append({key: tweet[key] for key in ["id", "created_at", "text"]})
+
+    return output_dict
+
+
+def twitter_queries(keywords, users_resp):
+    """
+    Helper function for get_twitter_data(.). The tweet search queries of a site.
+
+    Parameters
+    ----------
+    keywords: str
+        Name of a tourist site.
+    users_resp: list
+        Response of the user search.
+
+    Returns
+    -------
+    dict
+        In the form of {"query": "group name"}.
+    """
     usernames = [user["screen_name"] for user in users_resp]
-    # print(usernames)
-    output_dict = dict()
+    # one query per user covering tweets from, to and mentioning the user; in case no tweets can be retrieved this
+    # way: directly query by "keywords"
+    groups = {f"from:{user} OR to:{user} OR @{user}": user for user in usernames}
+    groups[keywords] = f"keywords--{keywords}"
 
-    # retrieve tweets by user
+    return groups
+
+
+def timeline_filename(cache_filename):
+    """
+    Name of the tweet timeline store kept next to a Twitter cache file.
+
+    Parameters
+    ----------
+    cache_filename: str
+        Twitter cache file.
+
+    Returns
+    -------
+    str
+        E.g. "cache_twitter_timeline.json" for "cache_twitter.json".
+    """
+    root, ext = os.path.splitext(cache_filename)
+
+    return f"{root}_timeline{ext or '.json'}"
+
+
+def refresh_timeline(timeline, groups, max_tweets):
+    """
+    Helper function for get_twitter_data(.). Fetches the tweets newer than the timeline's for the given queries and
+    merges them in. Only queries answered by Twitter get a new "fetched_at"; those skipped for lack of rate limit
+    budget (or failed) keep their old tweets, "since_id" and "fetched_at", so they are retried on the next refresh.
+
+    Parameters
+    ----------
+    timeline: dict
+        In the form of {"fetched_at": {"query": float}, "since_ids": {"query": str}, "tweets": list}, where "tweets"
+        holds {"id": str, "group": str, "created_at": str, "text": str} newest first.
+    groups: dict
+        In the form of {"query": "group name"}, the queries to refresh.
+    max_tweets: int
+        Maximal number of tweets kept.
+
+    Returns
+    -------
+    dict
+        The updated timeline.
+    """
     baseurl = "https://api.twitter.com/1.1/search/tweets.json"
-    queries = ["from:{user}".format, "to:{user}".format, "@{user}".format]
-    for username in usernames:
-        user_dict = {}
-        for q_format in queries:
-            q = q_format(user=username)
-            params = {"q": q, "tweet_mode": "extended"}
-            resp = make_request_with_cache(baseurl, params, cache_filename)
-            user_dict.update({tweet["created_at"]: tweet["full_text"] for tweet in resp["statuses"]})
-        output_dict[username] = user_dict
-
-    # in case no tweets can be retrieved so far: directly query by "keywords"
-    params = {"q": keywords, "tweet_mode": "extended"}
-    resp = make_request_with_cache(baseurl, params, cache_filename)
-    output_dict[f"keywords--{keywords}"] = {tweet["created_at"]: tweet["full_text"] for tweet in resp["statuses"]}
+    tweets = {tweet["id"]: tweet for tweet in timeline["tweets"]}
+    since_ids = dict(timeline["since_ids"])
+    fetched_at = dict(timeline["fetched_at"])
+    for q, group in groups.items():
+        params = {"q": q, "tweet_mode": "extended", "count": 100}
+        if q in since_ids:
+            params["since_id"] = since_ids[q]
+        print("making new request")
+        try:
+            resp = make_request(baseurl, params)
+        except RateLimited:
+            continue
+        if not isinstance(resp, dict) or "statuses" not in resp:
+            continue
+        fetched_at[q] = time.time()
 
-    return output_dict
+        for tweet in resp["statuses"]:
+            tweet_id = tweet["id_str"]
+            if int(tweet_id) > int(since_ids.get(q, 0)):
+                since_ids[q] = tweet_id
+            if tweet_id not in tweets:
+                tweets[tweet_id] = {"id": tweet_id, "group": group, "created_at": tweet["created_at"],
+                                    "text": tweet["full_text"]}
 
+    newest = sorted(tweets.values(), key=lambda tweet: int(tweet["id"]), reverse=True)[:max_tweets]
 
-def get_map_data(place_name, cache_filename):
+    return {"fetched_at": fetched_at, "since_ids": since_ids, "tweets": newest}
+
+
+def get_map_data(place_name, cache_filename, region=default_region):
     """
     Query for map data. Return relevant information specified below.
 
@@ -147,6 +326,8 @@ def get_map_data(place_name, cache_filename):
         Name of the place to search.
     cache_filename: str
         Cache file to use.
+    region: Region
+        Region to search in.
 
     Returns
     -------
@@ -154,30 +335,119 @@ def get_map_data(place_name, cache_filename):
         In the form as:
         {"adminArea6": str, "adminArea6Type": str, ... "adminArea3": str, "adminArea3Type": str, "adminArea1": str,
         "adminArea1Type": str, "lat": float, "lng": float}
+        or an empty dict if no place in the region is found.
+
+    Raises
+    ------
+    RateLimited
+        If "place_name" is not cached and the MapQuest rate limit is exhausted.
+    """
+    output = get_map_data_batch([place_name], cache_filename, region)
+    if place_name not in output:
+        raise RateLimited(upstreams["http://www.mapquestapi.com/geocoding/v1/address"])
+
+    return output[place_name]
+
+
+def get_map_data_batch(place_names, cache_filename, region=default_region, max_requests=None):
+    """
+    get_map_data(.) for many places at once: the cache is read once, only the places not cached are requested, and
+    the new responses are saved in a single write.
+
+    Parameters
+    ----------
+    place_names: list
+        Names of the places to search.
+    cache_filename: str
+        Cache file to use.
+    region: Region
+        Region to search in.
+    max_requests: int
+        Maximal number of requests made to the upstream; the remaining uncached places are left out of the output.
+        Default: no limit.
+
+    Returns
+    -------
+    dict
+        In the form of {"place name": dict}, with each dict as described in get_map_data(.). Places not cached and not
+        requested, because of "max_requests" or the MapQuest rate limit, are left out.
     """
     baseurl = "http://www.mapquestapi.com/geocoding/v1/address"
-    params = {"key": map_quest_key,
-              "location": f"{place_name}, Michigan",
-              "maxResults": 5}
     cache = open_cache(cache_filename)
-    unique_key = construct_unique_key(baseurl, params)
-    if unique_key in cache:
-        print("fetching from cache...")
-        resp = cache[unique_key]
-        # return cache[unique_key]
+    new_entries = dict()
+    output = dict()
+    requests_made = 0
+    rate_limited = False
+    for place_name in dict.fromkeys(place_names):
+        params = map_params(place_name, region)
+        unique_key = construct_unique_key(baseurl, params, location_suffixes=(region.name, region.code))
+        if unique_key in cache:
+            resp = cache[unique_key]
+        elif unique_key in new_entries:
+            resp = new_entries[unique_key]
+        elif rate_limited or (max_requests is not None and requests_made >= max_requests):
+            continue
+        else:
+            print("making new request...")
+            requests_made += 1
+            try:
+                resp = rate_limited_get(baseurl, params)
+            except RateLimited:
+                # no budget left: don't wait for it again for each remaining place
+                rate_limited = True
+                continue
+            new_entries[unique_key] = resp
+        output[place_name] = parse_map_response(resp, region)
+
+    if len(new_entries) > 0:
+        save_cache(new_entries, cache_filename)
+
+    return output
+
+
+def map_params(place_name, region=default_region):
+    """
+    MapQuest query params of a place.
 
-    else:
-        print("making new request...")
-        resp = requests.get(baseurl, params=params).json()
-        cache[unique_key] = resp
-        save_cache(cache, cache_filename)
+    Parameters
+    ----------
+    place_name: str
+        Name of the place to search.
+    region: Region
+        Region to search in.
+
+    Returns
+    -------
+    dict
+        The params.
+    """
+    return {"key": map_quest_key,
+            "location": f"{place_name}, {region.name}",
+            "maxResults": 5}
+
+
+def parse_map_response(resp, region=default_region):
+    """
+    Helper function for get_map_data_batch(.). Picks the first location in "region" from a MapQuest response.
+
+    Parameters
+    ----------
+    resp: dict
+        MapQuest geocoding response.
+    region: Region
+        Region to search in.
 
+    Returns
+    -------
+    dict
+        See get_map_data(.).
+    """
     # pprint(resp, indent=2)
 
     locations = resp["results"][0]["locations"]
     location = None
     for loc in locations:
-        if loc["adminArea3"] == "MI":
+        if loc["adminArea3"] == region.code:
             location = loc
             break
 
@@ -200,7 +470,8 @@ def get_map_data(place_name, cache_filename):
 
 def get_weather_data(lat, lon, cache_filename):
     """
-    Query for 5 days / 3 hours data, i.e. 40 forecasting data points.
+    Query for 5 days / 3 hours data, i.e. 40 forecasting data points. Coordinates are snapped to a grid of
+    "weather_grid_decimals" decimals, so sites in the same grid cell share one cached forecast.
 
     Parameters
     ----------
@@ -214,11 +485,12 @@ def get_weather_data(lat, lon, cache_filename):
     -------
     list
         List of dicts, each of which in the form of:
-        {"temp": float, "desc": str, "wind_speed": float}
+        {"temp": float, "desc": str, "wind_speed": float, "dt": int, "timezone": int}
+        where "dt" is the forecast time as a UNIX timestamp and "timezone" the local offset from UTC in seconds.
+        Empty if the weather API rate limit is exhausted.
     """
     baseurl = "https://community-open-weather-map.p.rapidapi.com/forecast"
-    params = {"lat": f"{lat}", "lon": f"{lon}", "units": "\"metric\" or \"imperial\""}
-    # params = {"lat": f"{lat}", "lon": f"{lon}", "units": "\"metric\""}
+    params = weather_params(lat, lon)
 
     headers = {
         'x-rapidapi-key': f"{open_weather_key}",
@@ -233,23 +505,192 @@ def get_weather_data(lat, lon, cache_filename):
 
     else:
         print("making new request...")
-        resp = requests.get(baseurl, headers=headers, params=params).json()
+        try:
+            resp = rate_limited_get(baseurl, params, headers=headers)
+        except RateLimited:
+            return []
         cache[unique_key] = resp
         save_cache(cache, cache_filename)
 
     # pprint(resp, indent=2)
     out_data_list = []
     data_list = resp["list"]
+    timezone = resp.get("city", dict()).get("timezone", 0)
     for data_pt in data_list:
         dict_pt = dict()
         dict_pt["temp"] = data_pt["main"]["temp"] - 273.15
         # dict_pt["temp"] = data_pt["main"]["temp"]
         dict_pt["desc"] = data_pt["weather"][0]["description"]
         dict_pt["wind_speed"] = data_pt["wind"]["speed"]
+        dict_pt["dt"] = data_pt["dt"]
+        dict_pt["timezone"] = timezone
         out_data_list.append(dict_pt)
 
     return out_data_list
 
 
+def weather_params(lat, lon):
+    """
+    Forecast query params of a location, snapped to its weather grid cell (see weather_grid_cell(.)).
+
+    Parameters
+    ----------
+    lat, lon: float
+        Latitude and longitude.
+
+    Returns
+    -------
+    dict
+        The params.
+    """
+    lat, lon = weather_grid_cell(lat, lon)
+
+    return {"lat": f"{lat}", "lon": f"{lon}", "units": "\"metric\" or \"imperial\""}
+
+
+def weather_grid_cell(lat, lon):
+    """
+    Snaps coordinates to the grid used for weather queries.
+
+    Parameters
+    ----------
+    lat, lon: float
+        Latitude and longitude.
+
+    Returns
+    -------
+    tuple
+        (lat, lon) rounded to "weather_grid_decimals" decimals.
+    """
+    return round(float(lat), weather_grid_decimals), round(float(lon), weather_grid_decimals)
+
+
+def get_daily_weather(weather_data):
+    """
+    Aggregates 3-hour forecasting data points from get_weather_data(.) into daily statistics (by local date).
+
+    Parameters
+    ----------
+    weather_data: list
+        Output of get_weather_data(.).
+
+    Returns
+    -------
+    dict
+        In the form of
+        {"date": list[str], "temp_min": list[float], "temp_max": list[float], "temp_mean": list[float],
+        "wind_min": list[float], "wind_max": list[float], "wind_mean": list[float]}
+        with one entry per day, in ascending order of date.
+    """
+    keys = ["date", "temp_min", "temp_max", "temp_mean", "wind_min", "wind_max", "wind_mean"]
+    if len(weather_data) == 0:
+        return {key: [] for key in keys}
+
+    local_dt = np.array([data_pt["dt"] + data_pt["timezone"] for data_pt in weather_data], dtype=np.int64)
+    order = np.argsort(local_dt, kind="stable")
+    days = local_dt[order] // 86400
+    temp = np.array([data_pt["temp"] for data_pt in weather_data], dtype=np.float64)[order]
+    wind = np.array([data_pt["wind_speed"] for data_pt in weather_data], dtype=np.float64)[order]
+
+    starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+    counts = np.diff(np.r_[starts, len(days)])
+    output_dict = {"date": np.datetime_as_string(days[starts].astype("datetime64[D]")).tolist()}
+    for name, vals in [("temp", temp), ("wind", wind)]:
+        output_dict[f"{name}_min"] = np.minimum.reduceat(vals, starts).round(2).tolist()
+        output_dict[f"{name}_max"] = np.maximum.reduceat(vals, starts).round(2).tolist()
+        output_dict[f"{name}_mean"] = (np.add.reduceat(vals, starts) / counts).round(2).tolist()
+
+    return output_dict
+
+
+def missing_from_cache(keywords, place_name, lat, lon, caches, region=default_region):
+    """
+    Which of get_twitter_data(.), get_map_data(.) and get_weather_data(.) could not serve a site from the caches
+    alone. Takes the loaded caches, so that checking many sites reads each file once.
+
+    Parameters
+    ----------
+    keywords: str
+        Name of the tourist site, see get_twitter_data(.).
+    place_name: str
+        Place to geocode, see get_map_data(.).
+    lat, lon: float
+        Coordinates of the site, or None if it has none (no forecast needed).
+    caches: dict
+        In the form of {"twitter": dict, "twitter_timeline": dict, "map": dict, "weather": dict}, the loaded Twitter
+        cache, its timeline store (see timeline_filename(.)), map and weather caches.
+    region: Region
+        Region of the site.
+
+    Returns
+    -------
+    list
+        The kinds of data missing, among "twitter", "map" and "weather".
+    """
+    missing = []
+
+    user_baseurl = "https://api.twitter.com/1.1/users/search.json"
+    for q in [f"{keywords} {region.name}", f"{keywords}"]:
+        users_key = construct_unique_key(user_baseurl, {"q": q, "count": 3})
+        if users_key not in caches["twitter"]:
+            missing.append("twitter")
+            break
+        if len(caches["twitter"][users_key]) > 0:
+            fetched_at = caches["twitter_timeline"].get(keywords, dict()).get("fetched_at")
+            if not isinstance(fetched_at, dict) or \
+                    any(q not in fetched_at for q in twitter_queries(keywords, caches["twitter"][users_key])):
+                missing.append("twitter")
+            break
+
+    map_baseurl = "http://www.mapquestapi.com/geocoding/v1/address"
+    map_key = construct_unique_key(map_baseurl, map_params(place_name, region),
+                                   location_suffixes=(region.name, region.code))
+    if map_key not in caches["map"]:
+        missing.append("map")
+
+    weather_baseurl = "https://community-open-weather-map.p.rapidapi.com/forecast"
+    if lat is not None and lon is not None and \
+            construct_unique_key(weather_baseurl, weather_params(lat, lon)) not in caches["weather"]:
+        missing.append("weather")
+
+    return missing
+
+
+def rekey_caches(filenames, region=default_region):
+    """
+    Migrates cache files written with legacy keys to canonical keys (see utilities.construct_unique_key(.)) and
+    prints how many entries turn out to be duplicates, see utilities.rekey_cache(.). Weather entries are moved to
+    their grid cell, see weather_grid_cell(.).
+
+    Parameters
+    ----------
+    filenames: list
+        Cache files to migrate.
+    region: Region
+        Region the caches belong to. Caches written before regions were introduced belong to the default region.
+
+    Returns
+    -------
+    None
+    """
+    def transform(base_url, params):
+        if upstreams.get(base_url) == "openweather":
+            try:
+                lat, lon = weather_grid_cell(params["lat"], params["lon"])
+            except ValueError:
+                return params
+            params = dict(params, lat=f"{lat}", lon=f"{lon}")
+        return params
+
+    for filename in filenames:
+        stats = rekey_cache(filename, legacy_key_params, transform=transform,
+                            location_suffixes=(region.name, region.code))
+        print(f"{filename}: {stats['rekeyed']} keys rewritten, "
+              f"{stats['entries_before']} -> {stats['entries_after']} entries, "
+              f"{100 * stats['redundant_ratio']:.1f}% of entries were duplicate queries")
+
+
 if __name__ == '__main__':
-    pass
+    # migrate caches to canonical keys: python3 data_api.py cache_twitter.json cache_map.json cache_weather.json
+    import sys
+    rekey_caches(sys.argv[1:])
@@ -0,0 +1,177 @@
+# This file contains vectorized geographic computations
+import numpy as np
+from utilities import query
+from regions import default_region
+
+earth_radius_km = 6371.0088
+
+
+def load_site_coords(db_filename=default_region.db_filename):
+    """
+    Loads names, thumbnails and coordinates of all geocoded tourist sites.
+
+    Parameters
+    ----------
+    db_filename: str
+        Database filename.
+
+    Returns
+    -------
+    list, list, np.ndarray
+        Site names, photo URLs and an array of shape (N, 2) holding (lat, lng) in degrees, all in the same order.
+    """
+    q = """
+    SELECT T.Name, PhotoURL, Lat, Lng
+    FROM TouristSites T JOIN Maps M ON T.Name = M.Name
+    WHERE Lat IS NOT NULL AND Lng IS NOT NULL
+    ORDER BY T.Id
+    """
+    results = query(q, db_filename)
+    names = [result[0] for result in results]
+    photo_urls = [result[1] for result in results]
+    coords = np.array([result[2:] for result in results], dtype=np.float64).reshape(-1, 2)
+
+    return names, photo_urls, coords
+
+
+def haversine_matrix(origins, targets):
+    """
+    Great-circle distances between every origin and every target.
+
+    Parameters
+    ----------
+    origins: np.ndarray
+        Array of shape (M, 2) holding (lat, lng) in degrees.
+    targets: np.ndarray
+        Array of shape (N, 2) holding (lat, lng) in degrees.
+
+    Returns
+    -------
+    np.ndarray
+        Distance matrix of shape (M, N) in km.
+    """
+    origins = np.radians(np.asarray(origins, dtype=np.float64).reshape(-1, 2))
+    targets = np.radians(np.asarray(targets, dtype=np.float64).reshape(-1, 2))
+    lat1, lng1 = origins[:, 0:1], origins[:, 1:2]
+    lat2, lng2 = targets[:, 0], targets[:, 1]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def top_k_nearest(dist, k):
+    """
+    Indices of the "k" smallest entries of each row of "dist", sorted ascending.
+
+    Parameters
+    ----------
+    dist: np.ndarray
+        Distance matrix of shape (M, N).
+    k: int
+        Number of nearest targets to keep per row.
+
+    Returns
+    -------
+    np.ndarray
+        Index array of shape (M, min(k, N)).
+    """
+    k = min(k, dist.shape[1])
+    if k <= 0:
+        return np.empty((dist.shape[0], 0), dtype=np.intp)
+    if k < dist.shape[1]:
+        idx = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.tile(np.arange(dist.shape[1]), (dist.shape[0], 1))
+    order = np.argsort(np.take_along_axis(dist, idx, axis=1), axis=1)
+
+    return np.take_along_axis(idx, order, axis=1)
+
+
+def plan_route(dist, start_dists, max_rounds=50):
+    """
+    Orders stops for an open trip from a fixed start by the nearest-neighbor heuristic, then improves the order with
+    2-opt moves until no move shortens the trip.
+
+    Parameters
+    ----------
+    dist: np.ndarray
+        Pairwise distances between the stops, of shape (N, N).
+    start_dists: np.ndarray
+        Distances from the start to each stop, of shape (N,).
+    max_rounds: int
+        Upper bound on 2-opt improvement rounds.
+
+    Returns
+    -------
+    list, float
+        Visiting order as indices into the stops, and the total trip length.
+    """
+    n = len(start_dists)
+    if n == 0:
+        return [], 0.0
+
+    # node 0 is the start, node i + 1 is stop i
+    full = np.zeros((n + 1, n + 1), dtype=np.float64)
+    full[1:, 1:] = dist
+    full[0, 1:] = full[1:, 0] = start_dists
+
+    # nearest neighbor
+    path = [0]
+    unvisited = np.ones(n + 1, dtype=bool)
+    unvisited[0] = False
+    for _ in range(n):
+        row = np.where(unvisited, full[path[-1]], np.inf)
+        nxt = int(np.argmin(row))
+        path.append(nxt)
+        unvisited[nxt] = False
+    path = np.array(path)
+
+    # 2-opt: reversing path[i:j + 1] replaces edges (a, b) and (c, d) with (a, c) and (b, d); the start stays fixed and
+    # the trip is open, so reversing a tail only replaces (a, b) with (a, c)
+    for _ in range(max_rounds):
+        improved = False
+        for i in range(1, n):
+            a, b = path[i - 1], path[i]
+            c = path[i + 1:]
+            d = np.r_[path[i + 2:], -1]
+            has_d = d >= 0
+            delta = full[a, c] - full[a, b]
+            delta[has_d] += full[b, d[has_d]] - full[c[has_d], d[has_d]]
+            j = int(np.argmin(delta))
+            if delta[j] < -1e-9:
+                j += i + 1
+                path[i:j + 1] = path[i:j + 1][::-1]
+                improved = True
+        if not improved:
+            break
+
+    length = float(full[path[:-1], path[1:]].sum())
+
+    return (path[1:] - 1).tolist(), length
+
+
+def build_geojson(names, photo_urls, coords, urls):
+    """
+    GeoJSON FeatureCollection with one point per site, carrying its name, thumbnail and detail page link.
+
+    Parameters
+    ----------
+    names, photo_urls: list
+        Site names and photo URLs.
+    coords: np.ndarray
+        Array of shape (N, 2) holding (lat, lng) in degrees, in the same order.
+    urls: list
+        Detail page links, in the same order.
+
+    Returns
+    -------
+    dict
+        The FeatureCollection.
+    """
+    features = []
+    for name, photo_url, (lat, lng), url in zip(names, photo_urls, coords.tolist(), urls):
+        features.append({"type": "Feature",
+                         "geometry": {"type": "Point", "coordinates": [round(lng, 6), round(lat, 6)]},
+                         "properties": {"name": name, "photo_url": photo_url, "url": url}})
+
+    return {"type": "FeatureCollection", "features": features}
@@ -0,0 +1,16 @@
+# Gunicorn settings for "gunicorn -c gunicorn.conf.py wsgi:app". Override with environment variables.
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "127.0.0.1:5000")
+
+# preforked workers, each serving requests with a pool of threads
+workers = int(os.environ.get("WEB_WORKERS", multiprocessing.cpu_count()))
+threads = int(os.environ.get("WEB_THREADS", 4))
+worker_class = "gthread"
+
+# import wsgi.py (and thus initialize the DB) once in the master, before forking
+preload_app = True
+
+# upstream API calls on a cold cache can be slow
+timeout = int(os.environ.get("WEB_TIMEOUT", 60))
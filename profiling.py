@@ -0,0 +1,315 @@
+# This file implements opt-in request profiling and the Server-Timing header
+import cProfile
+import functools
+import json
+import os
+import random
+import re
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from jinja2 import Template
+
+# PROFILE_REQUESTS=1 profiles every request, PROFILE_SAMPLE_RATE=0.05 a random 5% of them; the newest
+# PROFILE_MAX_FILES profiles are kept in PROFILE_DIR. A single request can also be profiled by adding
+# "?profile=<token>", see make_profile_token(.)
+profile_all = os.environ.get("PROFILE_REQUESTS", "0").lower() in ("1", "true", "yes")
+profile_sample_rate = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+profile_dir = os.environ.get("PROFILE_DIR", "profiles")
+profile_max_files = int(os.environ.get("PROFILE_MAX_FILES", 200))
+
+# profile tokens are signed with PROFILE_SECRET (environment variable, or defined in secrets.py) and expire after
+# PROFILE_TOKEN_MAX_AGE seconds; without a secret, tokens are disabled
+profile_secret = os.environ.get("PROFILE_SECRET") or getattr(secrets, "PROFILE_SECRET", None)
+profile_token_max_age = int(os.environ.get("PROFILE_TOKEN_MAX_AGE", 3600))
+profile_salt = "request-profile"
+
+# phase times of the current thread when it works for a request from a thread pool, see timed_map(.)
+thread_timings = threading.local()
+
+
+@contextmanager
+def phase_timer(phase):
+    """
+    Adds the time spent in the enclosed block to "phase" of the current request's Server-Timing header. Nested
+    blocks of the same phase are counted once; outside of a request (or of timed_map(.)) this does nothing.
+
+    Parameters
+    ----------
+    phase: str
+        Phase name, e.g. "db", "cache", "upstream", "plot" or "render".
+
+    Returns
+    -------
+    None
+    """
+    if has_request_context() and "phase_times" in g:
+        times, depths = g.phase_times, g.phase_depth
+    elif getattr(thread_timings, "times", None) is not None:
+        times, depths = thread_timings.times, thread_timings.depth
+    else:
+        yield
+        return
+
+    depth = depths.get(phase, 0)
+    depths[phase] = depth + 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        depths[phase] = depth
+        if depth == 0:
+            times[phase] = times.get(phase, 0.0) + time.perf_counter() - start
+
+
+def timed(phase):
+    """
+    Decorator version of phase_timer(.).
+
+    Parameters
+    ----------
+    phase: str
+        Phase name.
+
+    Returns
+    -------
+    callable
+        The decorator.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase_timer(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def run_with_timings(func, arg):
+    """
+    Helper function for timed_map(.). Runs "func(arg)" in a worker thread, recording its phase times.
+
+    Parameters
+    ----------
+    func: callable
+        The function.
+    arg:
+        Its argument.
+
+    Returns
+    -------
+    tuple
+        The result and the phase times in the form of {"phase": float}.
+    """
+    thread_timings.times, thread_timings.depth = dict(), dict()
+    try:
+        return func(arg), thread_timings.times
+    finally:
+        thread_timings.times, thread_timings.depth = None, None
+
+
+def timed_map(executor, func, iterable):
+    """
+    executor.map(.) for work of the current request done in a thread pool. Worker threads have no request context,
+    so their phase times are collected per call and added to the request's; concurrent calls are summed, so a phase
+    may exceed the request's total.
+
+    Parameters
+    ----------
+    executor: concurrent.futures.Executor
+        The thread pool.
+    func: callable
+        Function of one argument.
+    iterable: iterable
+        Arguments.
+
+    Returns
+    -------
+    list
+        The results, in the order of "iterable".
+    """
+    results = []
+    for result, times in executor.map(functools.partial(run_with_timings, func), iterable):
+        results.append(result)
+        if has_request_context() and "phase_times" in g:
+            for phase, t in times.items():
+                g.phase_times[phase] = g.phase_times.get(phase, 0.0) + t
+
+    return results
+
+
+class TimedTemplate(Template):
+    """
+    Jinja template which counts its rendering time as the "render" phase.
+    """
+    def render(self, *args, **kwargs):
+        with phase_timer("render"):
+            return super().render(*args, **kwargs)
+
+
+def make_profile_token():
+    """
+    Creates a token that enables profiling of single requests via "?profile=<token>" for "profile_token_max_age"
+    seconds.
+
+    Returns
+    -------
+    str
+        The token.
+
+    Raises
+    ------
+    RuntimeError
+        If no "profile_secret" is configured.
+    """
+    if profile_secret is None:
+        raise RuntimeError("set PROFILE_SECRET (environment or secrets.py) to enable profile tokens")
+
+    return URLSafeTimedSerializer(profile_secret, salt=profile_salt).dumps("profile")
+
+
+def should_profile():
+    """
+    Helper function for init_profiling(.). Decides whether to profile the current request.
+
+    Returns
+    -------
+    bool
+        Whether to profile.
+    """
+    token = request.args.get("profile")
+    if token is not None:
+        if profile_secret is None:
+            return False
+        try:
+            serializer = URLSafeTimedSerializer(profile_secret, salt=profile_salt)
+            return serializer.loads(token, max_age=profile_token_max_age) == "profile"
+        except BadSignature:  # includes expired tokens
+            return False
+
+    return profile_all or random.random() < profile_sample_rate
+
+
+def save_profile(profiler, response, latency):
+    """
+    Helper function for init_profiling(.). Saves the profile of the current request as "<name>.prof" (readable with
+    pstats or snakeviz) and its metadata as "<name>.json" in "profile_dir", then prunes the oldest profiles beyond
+    "profile_max_files".
+
+    Parameters
+    ----------
+    profiler: cProfile.Profile
+        The stopped profiler.
+    response: flask.Response
+        The response.
+    latency: float
+        Request latency in seconds.
+
+    Returns
+    -------
+    None
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    endpoint = re.sub(r"[^A-Za-z0-9_.-]", "_", request.endpoint or "unknown")
+    # random suffix: several requests of a worker may finish in the same second with the same latency
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{endpoint}_{latency * 1000:.0f}ms_{os.urandom(3).hex()}"
+    path = os.path.join(profile_dir, name)
+    profiler.dump_stats(f"{path}.prof")
+    metadata = {"method": request.method,
+                "path": request.path,
+                "endpoint": request.endpoint,
+                "route": str(request.url_rule) if request.url_rule is not None else None,
+                "status": response.status_code,
+                "latency_ms": round(latency * 1000, 3),
+                "phases_ms": {phase: round(t * 1000, 3) for phase, t in g.phase_times.items()},
+                "time": time.time(),
+                "pid": os.getpid()}
+    with open(f"{path}.json", "w") as wf:
+        wf.write(json.dumps(metadata, indent=2))
+
+    prune_profiles()
+
+
+def prune_profiles():
+    """
+    Helper function for save_profile(.). Deletes the oldest profiles in "profile_dir" (with their metadata), keeping
+    the newest "profile_max_files".
+
+    Returns
+    -------
+    None
+    """
+    profiles = []
+    for entry in os.scandir(profile_dir):
+        if entry.name.endswith(".prof"):
+            try:
+                profiles.append((entry.stat().st_mtime, entry.path[:-len(".prof")]))
+            except FileNotFoundError:  # pruned by another worker
+                pass
+
+    for _, path in sorted(profiles)[:max(len(profiles) - profile_max_files, 0)]:
+        for ext in [".prof", ".json"]:
+            try:
+                os.remove(f"{path}{ext}")
+            except FileNotFoundError:
+                pass
+
+
+def init_profiling(app):
+    """
+    Registers the profiling hooks on "app": every response gets a Server-Timing header breaking its latency down by
+    phase (see phase_timer(.)), and requests selected by should_profile(.) run under cProfile.
+
+    Parameters
+    ----------
+    app: Flask
+        The app.
+
+    Returns
+    -------
+    None
+    """
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.before_request
+    def start_request_timing():
+        g.request_start = time.perf_counter()
+        g.phase_times = dict()
+        g.phase_depth = dict()
+        g.profiler = None
+        if should_profile():
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def finish_request_timing(response):
+        if "request_start" not in g:
+            return response
+        latency = time.perf_counter() - g.request_start
+        if g.profiler is not None:
+            g.profiler.disable()
+            try:
+                save_profile(g.profiler, response, latency)
+            except OSError as e:
+                print(f"could not save profile: {e}")
+            g.profiler = None
+
+        timings = [f"{phase};dur={t * 1000:.1f}" for phase, t in g.phase_times.items()]
+        timings.append(f"total;dur={latency * 1000:.1f}")
+        response.headers["Server-Timing"] = ", ".join(timings)
+
+        return response
+
+    @app.teardown_request
+    def stop_profiler(exc):
+        # after_request is skipped if the request failed; never leave the profiler running on this thread
+        if g.get("profiler") is not None:
+            g.profiler.disable()
+
+
+if __name__ == '__main__':
+    # print a token for "?profile=<token>"
+    print(make_profile_token())
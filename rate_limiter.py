@@ -0,0 +1,288 @@
+# This file implements per-upstream rate limiting for Web API calls
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from utilities import cache_lock, open_cache, write_cache_file
+
+# request priorities: lower value goes first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+request_priority = ContextVar("request_priority", default=INTERACTIVE)
+
+# when set to a list, upstreams whose calls were skipped for lack of budget are appended to it
+skipped_requests = ContextVar("skipped_requests", default=None)
+
+
+class RateLimited(Exception):
+    """
+    Raised when an upstream's request budget is used up. Callers should fall back to cached or empty data.
+    """
+    pass
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket. Interactive callers may spend every token; background callers leave "reserve" of
+    the capacity to interactive ones and always queue behind waiting interactive callers (of the same process).
+
+    With a "state_filename", the bucket's tokens are kept in that file instead of in memory, so that all processes
+    using the same file (server workers, warm_cache.py) share a single budget.
+
+    Attributes
+    ----------
+    name: str
+        Name of the upstream, for logging.
+    capacity: float
+        Maximal number of tokens, i.e. the largest burst.
+    rate: float
+        Tokens refilled per second.
+    reserve: float
+        Number of tokens background callers may not spend.
+    tokens: float
+        Tokens currently available.
+    blocked_until: float
+        time.time() before which no request may be made, as announced by the upstream.
+    state_filename: str
+        JSON file holding the shared state of the bucket, or None to keep it in this process.
+    """
+    def __init__(self, name, limit, window, reserve=0.2, state_filename=None):
+        """
+        Parameters
+        ----------
+        name: str
+            Name of the upstream.
+        limit: int
+            Number of requests allowed per "window".
+        window: float
+            Length of the quota window in seconds.
+        reserve: float
+            Fraction of "limit" kept for interactive callers.
+        state_filename: str
+            JSON file holding the shared state of the bucket. Default: not shared.
+        """
+        self.name = name
+        self.capacity = float(limit)
+        self.rate = limit / window
+        self.reserve = reserve * limit
+        self.tokens = float(limit)
+        self.blocked_until = 0.0
+        self.last_refill = time.time()
+        self.state_filename = state_filename
+        self.waiting_interactive = 0
+        self.cond = threading.Condition()
+
+    def __repr__(self):
+        return f"TokenBucket({self.name}, {self.tokens:.1f}/{self.capacity:.0f})"
+
+    @contextmanager
+    def _synced(self):
+        # load the shared state, and store it back when the enclosed block has updated it; call with "cond" held
+        if self.state_filename is None:
+            yield
+            return
+
+        with cache_lock(self.state_filename):
+            states = open_cache(self.state_filename)
+            if self.name in states:
+                state = states[self.name]
+                self.tokens = min(self.capacity, state["tokens"])
+                self.last_refill = state["last_refill"]
+                self.blocked_until = state["blocked_until"]
+            yield
+            states[self.name] = {"tokens": self.tokens, "last_refill": self.last_refill,
+                                 "blocked_until": self.blocked_until}
+            write_cache_file(states, self.state_filename)
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def _can_spend(self, priority):
+        if time.time() < self.blocked_until:
+            return False
+        if priority == INTERACTIVE:
+            return self.tokens >= 1
+        return self.waiting_interactive == 0 and self.tokens - 1 >= self.reserve
+
+    def _wait_time(self, priority):
+        if time.time() < self.blocked_until:
+            return self.blocked_until - time.time()
+        floor = 1 if priority == INTERACTIVE else self.reserve + 1
+        return max((floor - self.tokens) / self.rate, 0.01)
+
+    def acquire(self, priority=None, timeout=None):
+        """
+        Takes one token, waiting at most "timeout" seconds for it. Gives up at once if no token can be refilled (or
+        the upstream's block end) within "timeout".
+
+        Parameters
+        ----------
+        priority: int
+            INTERACTIVE or BACKGROUND. Defaults to the current request_priority.
+        timeout: float
+            Maximal waiting time in seconds. Defaults to 1 for interactive and 60 for background callers.
+
+        Returns
+        -------
+        bool
+            Whether a token was taken.
+        """
+        if priority is None:
+            priority = request_priority.get()
+        if timeout is None:
+            timeout = 1 if priority == INTERACTIVE else 60
+        deadline = time.monotonic() + timeout
+
+        with self.cond:
+            if priority == INTERACTIVE:
+                self.waiting_interactive += 1
+            try:
+                while True:
+                    with self._synced():
+                        self._refill()
+                        spent = self._can_spend(priority)
+                        if spent:
+                            self.tokens -= 1
+                    if spent:
+                        return True
+                    remaining = deadline - time.monotonic()
+                    wait = self._wait_time(priority)
+                    if wait > remaining:
+                        # no token can arrive in time: fail now instead of sleeping through the timeout
+                        return False
+                    self.cond.wait(wait)
+            finally:
+                if priority == INTERACTIVE:
+                    self.waiting_interactive -= 1
+                    self.cond.notify_all()
+
+    def update(self, remaining=None, reset_at=None):
+        """
+        Syncs the bucket with the budget reported by the upstream.
+
+        Parameters
+        ----------
+        remaining: int
+            Requests left in the current window, as reported by the upstream.
+        reset_at: float
+            time.time() at which the upstream window resets.
+
+        Returns
+        -------
+        None
+        """
+        with self.cond:
+            with self._synced():
+                self._refill()
+                if remaining is not None:
+                    self.tokens = min(self.tokens, float(remaining))
+                    if remaining <= 0 and reset_at is not None:
+                        self.blocked_until = max(self.blocked_until, reset_at)
+            self.cond.notify_all()
+
+
+# bucket state shared by all processes of this deployment (environment variable RATE_LIMIT_STATE)
+rate_limit_state_filename = os.environ.get("RATE_LIMIT_STATE", "rate_limits.json")
+
+# wait after HTTP 429 when the upstream doesn't say how long (no "Retry-After" or reset header)
+retry_backoff = 60
+
+# known quotas (requests, window in seconds), from the providers' documentation
+quotas = {
+    "twitter_users": (900, 15 * 60),
+    "twitter_search": (180, 15 * 60),
+    "mapquest": (15000, 30 * 24 * 3600),
+    "openweather": (100, 60),
+}
+
+limiters = {name: TokenBucket(name, limit, window, state_filename=rate_limit_state_filename)
+            for name, (limit, window) in quotas.items()}
+
+
+@contextmanager
+def background_priority():
+    """
+    Runs the enclosed upstream calls of the current thread with BACKGROUND priority.
+
+    Returns
+    -------
+    None
+    """
+    token = request_priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+def update_from_headers(upstream, headers, status_code=200):
+    """
+    Syncs an upstream's bucket with the rate limit headers of a response. Understands Twitter's "x-rate-limit-*"
+    (reset as epoch seconds) and RapidAPI's "x-ratelimit-requests-*" (reset as seconds from now) headers. After a
+    429, requests resume at the announced reset, else after "Retry-After", else after "retry_backoff" seconds.
+
+    Parameters
+    ----------
+    upstream: str
+        Key into "limiters".
+    headers: dict
+        Response headers (case-insensitive, as in requests.Response.headers).
+    status_code: int
+        HTTP status of the response; 429 blocks the bucket until requests may resume.
+
+    Returns
+    -------
+    None
+    """
+    remaining, reset_at = None, None
+    try:
+        if "x-rate-limit-remaining" in headers:
+            remaining = int(headers["x-rate-limit-remaining"])
+            if "x-rate-limit-reset" in headers:
+                reset_at = float(headers["x-rate-limit-reset"])
+        elif "x-ratelimit-requests-remaining" in headers:
+            remaining = int(headers["x-ratelimit-requests-remaining"])
+            if "x-ratelimit-requests-reset" in headers:
+                reset_at = time.time() + float(headers["x-ratelimit-requests-reset"])
+    except ValueError:
+        pass
+
+    if status_code == 429:
+        remaining = 0
+        if reset_at is None:
+            reset_at = time.time() + parse_retry_after(headers.get("retry-after"))
+
+    if remaining is not None:
+        limiters[upstream].update(remaining, reset_at)
+
+
+def parse_retry_after(value):
+    """
+    Helper function for update_from_headers(.). Parses a "Retry-After" header, given either as seconds or as an
+    HTTP date.
+
+    Parameters
+    ----------
+    value: str
+        Header value, or None if absent.
+
+    Returns
+    -------
+    float
+        Seconds to wait; "retry_backoff" if the header is absent or malformed.
+    """
+    if value is None:
+        return retry_backoff
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return retry_backoff
@@ -0,0 +1,159 @@
+# This file defines the regions (states) served, each with its own database and cache files
+import os
+import re
+
+
+class Region(object):
+    """
+    A region of the catalog. Every region is scraped by the same pipeline into its own database ("shard") and cache
+    files, and is looked up by its code.
+
+    Attributes
+    ----------
+    code: str
+        Two-letter state code as reported by MapQuest's "adminArea3", e.g. "MI".
+    name: str
+        State name, e.g. "Michigan". Appended to free-text locations for geocoding and Twitter searches.
+    bbox: tuple
+        Bounding box (south, west, north, east) in degrees, for routing coordinates to the region.
+    main_url: str
+        Planetware page listing the region's destinations.
+    excluding_pattern: re.Pattern
+        Destination links on "main_url" (lower case) that are not lists of sites.
+    db_filename: str
+        Database filename.
+    cache_prefix: str
+        Prefix of the region's cache files, see cache_filename(.).
+    default_place: str
+        Place shown on maps and weather pages of sites without a location.
+    """
+    def __init__(self, code, name, bbox, excluding_pattern=r".*(tents|in pictures).*", db_filename=None,
+                 cache_prefix=None, default_place=None):
+        self.code = code
+        self.name = name
+        self.bbox = bbox
+        slug = name.lower().replace(" ", "-")
+        self.main_url = f"https://www.planetware.com/{slug}-tourism-vacations-us{code.lower()}.htm"
+        self.excluding_pattern = re.compile(excluding_pattern)
+        self.db_filename = db_filename or f"{name.replace(' ', '')}TouristSites.sqlite"
+        self.cache_prefix = cache_prefix or f"cache_{code.lower()}"
+        self.default_place = default_place or name
+
+    def __repr__(self):
+        return f"Region({self.code}, {self.name})"
+
+    def cache_filename(self, kind):
+        """
+        Cache file of the region for one kind of data.
+
+        Parameters
+        ----------
+        kind: str
+            "scraper", "twitter", "map" or "weather".
+
+        Returns
+        -------
+        str
+            E.g. "cache_oh_map.json".
+        """
+        return f"{self.cache_prefix}_{kind}.json"
+
+    def contains(self, lat, lng, margin=0.0):
+        """
+        Whether a point lies in the region's bounding box, grown by "margin" degrees on each side.
+
+        Parameters
+        ----------
+        lat, lng: float
+            Latitude and longitude.
+        margin: float
+            Margin in degrees.
+
+        Returns
+        -------
+        bool
+        """
+        south, west, north, east = self.bbox
+        return south - margin <= lat <= north + margin and west - margin <= lng <= east + margin
+
+    def center(self):
+        """
+        Center of the region's bounding box.
+
+        Returns
+        -------
+        tuple
+            (lat, lng) in degrees.
+        """
+        south, west, north, east = self.bbox
+        return (south + north) / 2, (west + east) / 2
+
+
+# Michigan keeps the file names used before regions were introduced
+regions = {region.code: region for region in [
+    Region("MI", "Michigan", (41.69, -90.42, 48.31, -82.12),
+           excluding_pattern=r".*(tents|where to stay in detroit|michigan in pictures).*",
+           db_filename="MichiganTouristSites.sqlite", cache_prefix="cache", default_place="Ann Arbor"),
+    Region("OH", "Ohio", (38.40, -84.82, 41.98, -80.52)),
+    Region("IN", "Indiana", (37.77, -88.10, 41.76, -84.78)),
+    Region("IL", "Illinois", (36.97, -91.51, 42.51, -87.02)),
+    Region("WI", "Wisconsin", (42.49, -92.89, 47.31, -86.25)),
+]}
+
+default_region = regions["MI"]
+
+
+def get_region(code):
+    """
+    Looks up a region by code, case-insensitively.
+
+    Parameters
+    ----------
+    code: str
+        Region code; None gives the default region.
+
+    Returns
+    -------
+    Region
+        The region, or None if "code" is unknown.
+    """
+    if code is None:
+        return default_region
+
+    return regions.get(code.upper())
+
+
+def served_regions():
+    """
+    Regions served by this deployment: those listed in the environment variable REGIONS (comma-separated codes,
+    default "MI").
+
+    Returns
+    -------
+    list
+        List of Region.
+    """
+    codes = [code.strip() for code in os.environ.get("REGIONS", default_region.code).split(",") if code.strip()]
+
+    return [regions[code.upper()] for code in codes]
+
+
+def regions_for_point(lat, lng, margin=0.5):
+    """
+    Served regions whose database exists and whose bounding box (grown by "margin" degrees, so that sites across a
+    border are found) contains a point. Used to route proximity searches to shards.
+
+    Parameters
+    ----------
+    lat, lng: float
+        Latitude and longitude.
+    margin: float
+        Margin in degrees.
+
+    Returns
+    -------
+    list
+        List of Region.
+    """
+    return [region for region in served_regions()
+            if region.contains(lat, lng, margin) and os.path.exists(region.db_filename)]
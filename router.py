@@ -1,15 +1,244 @@
 import plotly.graph_objects as go
 from plotly import io
 
-from flask import Flask, url_for, render_template, redirect, session, request
+import gzip
+import hashlib
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, url_for, render_template, redirect, session, request, jsonify, Response, g, abort
 from pprint import pprint
 from utilities import query
-from data_api import get_map_data
+from data_api import get_map_data, get_map_data_batch, get_weather_data, get_daily_weather, weather_grid_cell
 from classes import *
+from geo import load_site_coords, haversine_matrix, top_k_nearest, plan_route, build_geojson
+from profiling import init_profiling, timed, timed_map
+from regions import default_region, get_region, served_regions, regions_for_point
+from rate_limiter import RateLimited
 from secrets import *
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = "MI_travel"
+init_profiling(app)
+
+site_catalog = dict()
+site_distances = dict()
+site_layers = dict()
+
+# bounds on the work of one /api/nearby call, so that it finishes well within the server timeout
+max_nearby_origins = 1000
+max_nearby_geocodes = 20
+
+# answer for place names that can't be geocoded now because the MapQuest rate limit is exhausted
+geocoding_limit_msg = "geocoding limit reached, retry later"
+
+
+@app.before_request
+def select_region():
+    # every page works on the region given by "?region=<code>" (default region if absent)
+    g.region = get_region(request.args.get("region"))
+    if g.region is None or g.region not in served_regions():
+        abort(404)
+
+
+@app.url_defaults
+def add_region(endpoint, values):
+    # keep links within the current region
+    region = g.get("region")
+    if region is not None and region is not default_region:
+        values.setdefault("region", region.code)
+
+
+@app.context_processor
+def inject_regions():
+    return {"regions": served_regions()}
+
+
+def get_site_catalog(db_filename=default_region.db_filename):
+    """
+    Site names, photo URLs and coordinate array, loaded from the DB once per process and reused by all requests.
+
+    Parameters
+    ----------
+    db_filename: str
+        Database filename.
+
+    Returns
+    -------
+    dict
+        In the form of {"names": list, "photo_urls": list, "coords": np.ndarray of shape (N, 2),
+        "index": {"site name": int}, "sites": set}, where "names", "photo_urls", "coords" and "index" cover the
+        geocoded sites and "sites" holds the names of all sites.
+    """
+    if db_filename not in site_catalog:
+        names, photo_urls, coords = load_site_coords(db_filename)
+        site_catalog[db_filename] = {"names": names, "photo_urls": photo_urls, "coords": coords,
+                                     "index": {name: i for i, name in enumerate(names)},
+                                     "sites": set(result[0] for result in query("SELECT Name FROM TouristSites",
+                                                                                db_filename))}
+
+    return site_catalog[db_filename]
+
+
+def get_distances(db_filename=default_region.db_filename):
+    """
+    The precomputed all-pairs site distance matrix, loaded from the DB once per process.
+
+    Parameters
+    ----------
+    db_filename: str
+        Database filename.
+
+    Returns
+    -------
+    dict
+        In the form of {"index": {"site name": int}, "dist": np.ndarray of shape (N, N)}.
+    """
+    if db_filename not in site_distances:
+        names, dist = load_distance_matrix(db_filename)
+        site_distances[db_filename] = {"index": {name: i for i, name in enumerate(names)}, "dist": dist}
+
+    return site_distances[db_filename]
+
+
+def get_sites_geojson(region=default_region):
+    """
+    The GeoJSON layer of all sites of a region (see geo.build_geojson(.)), built and gzipped once per process and
+    application root, since its links are built with url_for(.). Needs a request context.
+
+    Parameters
+    ----------
+    region: Region
+        The region.
+
+    Returns
+    -------
+    dict
+        In the form of {"gzip": bytes, "version": str}, where "version" is a hash of the layer's content.
+    """
+    key = (region.db_filename, request.script_root)
+    if key not in site_layers:
+        catalog = get_site_catalog(region.db_filename)
+        region_code = None if region is default_region else region.code
+        urls = [url_for("place_index", nm=name, region=region_code) for name in catalog["names"]]
+        geojson = build_geojson(catalog["names"], catalog["photo_urls"], catalog["coords"], urls)
+        data = json.dumps(geojson, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        site_layers[key] = {"gzip": gzip.compress(data, compresslevel=9, mtime=0),
+                            "version": hashlib.sha1(data).hexdigest()[:16]}
+
+    return site_layers[key]
+
+
+def load_region(region):
+    """
+    Loads the per-process data of a region's shard (site catalog, distance matrix, GeoJSON layer), so that the first
+    requests don't pay for it. Called at startup, before the server forks its workers. The GeoJSON layer is built
+    for an app served at the root; other roots build theirs on first use.
+
+    Parameters
+    ----------
+    region: Region
+        The region.
+
+    Returns
+    -------
+    None
+    """
+    get_site_catalog(region.db_filename)
+    get_distances(region.db_filename)
+    with app.test_request_context():
+        get_sites_geojson(region)
+
+
+def parse_start(text):
+    """
+    Helper function for itinerary(.). Turns form input "lat, lng" into a coordinate pair; anything else is kept as a
+    place name.
+
+    Parameters
+    ----------
+    text: str
+        Start location as typed by the user.
+
+    Returns
+    -------
+    str or list
+        See parse_origin(.).
+    """
+    parts = text.split(",")
+    if len(parts) == 2:
+        try:
+            return [float(part) for part in parts]
+        except ValueError:
+            pass
+
+    return text
+
+
+def parse_origin(origin, geocoded=None):
+    """
+    Helper function for nearby_api(.). Resolves an origin given as a place name, {"lat": float, "lng": float} or
+    [lat, lng] into coordinates.
+
+    Parameters
+    ----------
+    origin: str or dict or list
+        The origin as sent by the client.
+    geocoded: dict
+        Place names already looked up with data_api.get_map_data_batch(.). Default: look "origin" up.
+
+    Returns
+    -------
+    tuple
+        (lat, lng), or None if the origin is invalid or not in the current region.
+
+    Raises
+    ------
+    RateLimited
+        If "origin" has to be geocoded but the MapQuest rate limit is exhausted.
+    """
+    try:
+        if isinstance(origin, str):
+            if origin.strip() == "":
+                return None
+            if geocoded is None:
+                map_loc = get_map_data(origin, g.region.cache_filename("map"), g.region)
+            else:
+                map_loc = geocoded.get(origin, dict())
+            if len(map_loc) == 0:
+                return None
+            return map_loc["lat"], map_loc["lng"]
+        if isinstance(origin, dict):
+            lat, lng = float(origin["lat"]), float(origin["lng"])
+        else:
+            lat, lng = (float(val) for val in origin)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+
+    return lat, lng
+
+
+def default_location():
+    """
+    Helper function for place_map(.) and place_weather(.). Coordinates of the current region's default place, or of
+    the region's center if the default place can't be geocoded (e.g. MapQuest rate limit exhausted).
+
+    Returns
+    -------
+    tuple
+        (lat, lng).
+    """
+    try:
+        map_info_default = get_map_data(g.region.default_place, g.region.cache_filename("map"), g.region)
+    except RateLimited:
+        map_info_default = dict()
+    if len(map_info_default) == 0:
+        return g.region.center()
+
+    return map_info_default["lat"], map_info_default["lng"]
 
 
 @app.route("/", methods=["GET", "POST"])
@@ -27,14 +256,19 @@ def index():
     SELECT T.Name, PhotoURL, Lat, Lng
     FROM TouristSites T JOIN Maps M ON T.Name = M.Name
     """
-    results = query(q, "MichiganTouristSites.sqlite")
+    results = query(q, g.region.db_filename)
     msg = None
 
     if loc is not None and loc != "":
-        # validate input first by make an api call and see if a location in MI is returned
-        map_loc = get_map_data(loc, "cache_map.json")
+        # validate input first by make an api call and see if a location in the region is returned
+        try:
+            map_loc = get_map_data(loc, g.region.cache_filename("map"), g.region)
+        except RateLimited:
+            map_loc = None
         # print(map_loc)
-        if len(map_loc) == 0:
+        if map_loc is None:
+            msg = geocoding_limit_msg
+        elif len(map_loc) == 0:
             msg = "invalid input"
         else:
             results = [result for result in results if result[-1] is not None and result[-2] is not None]
@@ -48,17 +282,196 @@ def index():
     return render_template("index.html", msg=msg, results=results)
 
 
+@app.route("/api/nearby", methods=["POST"])
+def nearby_api():
+    """
+    Batch proximity search. Expects a JSON body in the form of
+    {"origins": ["place name", {"lat": float, "lng": float}, [lat, lng], ...], "k": int}
+    and ranks all sites for all origins at once by great-circle distance. Place names are looked up in the current
+    region; each origin is searched in the region shards whose bounding box contains it (see
+    regions.regions_for_point(.)), or in the current region if there is none.
+
+    At most "max_nearby_origins" origins are accepted, and at most "max_nearby_geocodes" place names that are not
+    cached yet are geocoded per call; the others are answered with an error and may be sent again later.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("origins"), list):
+        return jsonify({"error": "expected a JSON object with an \"origins\" list"}), 400
+    if len(body["origins"]) > max_nearby_origins:
+        return jsonify({"error": f"at most {max_nearby_origins} origins per request"}), 400
+    try:
+        k = int(body.get("k", 10))
+    except (TypeError, ValueError):
+        return jsonify({"error": "\"k\" must be an integer"}), 400
+
+    origins = body["origins"]
+    place_names = [origin for origin in origins if isinstance(origin, str) and origin.strip() != ""]
+    geocoded = get_map_data_batch(place_names, g.region.cache_filename("map"), g.region, max_nearby_geocodes)
+    resolved = [parse_origin(origin, geocoded) for origin in origins]
+    valid = [i for i, loc in enumerate(resolved) if loc is not None]
+
+    # route origins to shards
+    shards = dict()
+    for i in valid:
+        for region in regions_for_point(*resolved[i]) or [g.region]:
+            shards.setdefault(region.code, (region, []))[1].append(i)
+
+    # top k per origin within each shard, then merged across shards
+    candidates = {i: [] for i in valid}
+    for region, rows in shards.values():
+        catalog = get_site_catalog(region.db_filename)
+        dist = haversine_matrix(np.array([resolved[i] for i in rows]), catalog["coords"])
+        nearest = top_k_nearest(dist, max(k, 0))
+        for row, i in enumerate(rows):
+            candidates[i] += [(float(dist[row, j]), {"name": catalog["names"][j],
+                                                     "region": region.code,
+                                                     "lat": float(catalog["coords"][j, 0]),
+                                                     "lng": float(catalog["coords"][j, 1]),
+                                                     "distance_km": round(float(dist[row, j]), 3)})
+                              for j in nearest[row]]
+
+    output = [{"origin": origin, "error": geocoding_limit_msg}
+              if isinstance(origin, str) and origin.strip() != "" and origin not in geocoded
+              else {"origin": origin, "error": "invalid input"} for origin in origins]
+    for i in valid:
+        output[i] = {"origin": origins[i],
+                     "lat": resolved[i][0],
+                     "lng": resolved[i][1],
+                     "sites": [site for _, site in sorted(candidates[i], key=lambda c: c[0])[:max(k, 0)]]}
+
+    return jsonify({"results": output})
+
+
+def plan_itinerary(names, start):
+    """
+    Helper function for itinerary(.) and itinerary_api(.). Orders the sites "names" into a trip from "start".
+
+    Parameters
+    ----------
+    names: list
+        Site names to visit.
+    start: str or dict or list
+        Start location, see parse_origin(.).
+
+    Returns
+    -------
+    dict
+        In the form of
+        {"start": start, "stops": [{"name": str, "lat": float, "lng": float, "leg_km": float}, ...],
+        "total_km": float, "missing": list[str]}
+        or {"error": str} if "start" is invalid.
+
+    Raises
+    ------
+    RateLimited
+        If "start" has to be geocoded but the MapQuest rate limit is exhausted.
+    """
+    start_loc = parse_origin(start)
+    if start_loc is None:
+        return {"error": "invalid start location"}
+
+    catalog = get_site_catalog(g.region.db_filename)
+    distances = get_distances(g.region.db_filename)
+    names = list(dict.fromkeys(names))
+    missing = [name for name in names if name not in distances["index"] or name not in catalog["index"]]
+    names = [name for name in names if name not in missing]
+
+    idx = np.array([distances["index"][name] for name in names], dtype=np.intp)
+    coords = catalog["coords"][np.array([catalog["index"][name] for name in names], dtype=np.intp)]
+    dist = distances["dist"][np.ix_(idx, idx)]
+    start_dists = haversine_matrix(np.array([start_loc]), coords)[0]
+    order, total = plan_route(dist, start_dists)
+
+    stops = []
+    prev = None
+    for i in order:
+        leg = start_dists[i] if prev is None else dist[prev, i]
+        stops.append({"name": names[i],
+                      "lat": float(coords[i, 0]),
+                      "lng": float(coords[i, 1]),
+                      "leg_km": round(float(leg), 3)})
+        prev = i
+
+    return {"start": start, "stops": stops, "total_km": round(total, 3), "missing": missing}
+
+
+@app.route("/itinerary")
+def itinerary():
+    start = request.args.get("start", "")
+    names = request.args.getlist("sites")
+    try:
+        plan = plan_itinerary(names, parse_start(start))
+    except RateLimited:
+        return render_template("itinerary.html", start=start, plan={"error": geocoding_limit_msg}, retry_later=True)
+
+    return render_template("itinerary.html", start=start, plan=plan, retry_later=False)
+
+
+@app.route("/api/itinerary", methods=["POST"])
+def itinerary_api():
+    """
+    Expects a JSON body in the form of {"start": origin, "sites": ["site name", ...]}, with "start" given as accepted
+    by parse_origin(.), and returns the planned trip as described in plan_itinerary(.). Answers 503 if "start" can't be
+    geocoded now because of the MapQuest rate limit.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("sites"), list) or "start" not in body:
+        return jsonify({"error": "expected a JSON object with \"start\" and a \"sites\" list"}), 400
+    if not all(isinstance(name, str) for name in body["sites"]):
+        return jsonify({"error": "\"sites\" must be a list of site names"}), 400
+
+    try:
+        plan = plan_itinerary(body["sites"], body["start"])
+    except RateLimited:
+        return jsonify({"error": geocoding_limit_msg}), 503
+    if "error" in plan:
+        return jsonify(plan), 400
+
+    return jsonify(plan)
+
+
+@app.route("/sites.geojson")
+def sites_geojson():
+    """
+    All sites as GeoJSON, served pre-compressed with an ETag. Requested as "?v=<version>" (see get_sites_geojson(.)),
+    the response may be cached forever, since a catalog change changes the version.
+    """
+    layer = get_sites_geojson(g.region)
+    # the gzip and the identity body are different representations, so they need different strong ETags
+    use_gzip = "gzip" in request.accept_encodings
+    etag = f"{layer['version']}-gz" if use_gzip else layer["version"]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif use_gzip:
+        response = Response(layer["gzip"], mimetype="application/geo+json")
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(gzip.decompress(layer["gzip"]), mimetype="application/geo+json")
+
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    if request.args.get("v") == layer["version"]:
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+
+    return response
+
+
 @app.route("/<nm>")
 def place_index(nm):
+    # count views of actual sites only, not of any path such as "/favicon.ico"
+    if nm in get_site_catalog(g.region.db_filename)["sites"]:
+        record_visit(nm, g.region.db_filename)
     return render_template("place_index.html", name=nm)
 
 
 @app.route("/<nm>/desc")
 def place_desc(nm):
-    tourist_site = load_from_db(nm)
+    tourist_site = load_from_db(nm, g.region.db_filename, g.region)
     desc = tourist_site.desc
     photo_url = tourist_site.photo_url
-    twitter = tourist_site.get_twitter("cache_twitter.json")
+    twitter = tourist_site.get_twitter(g.region.cache_filename("twitter"))
 
     # pprint(twitter)
 
@@ -67,19 +480,21 @@ def place_desc(nm):
 
 @app.route("/<nm>/map")
 def place_map(nm):
-    map_place_default = "Ann Arbor"
-    tourist_site = load_from_db(nm)
+    tourist_site = load_from_db(nm, g.region.db_filename, g.region)
     address = tourist_site.address
     lat, lon = tourist_site.lat, tourist_site.lon
 
     if lat is None or lon is None:
-        map_info_default = get_map_data(map_place_default, "cache_map.json")
-        lat, lon = map_info_default["lat"], map_info_default["lng"]
+        lat, lon = default_location()
 
     # print(f"lon: {lon}, lat: {lat}")
-    return render_template("map.html", API_KEY=MAPBOX_API_KEY, name=nm, address=address, lat=lat, lon=lon)
+    layer = get_sites_geojson(g.region)
+    geojson_url = url_for("sites_geojson", v=layer["version"])
+    return render_template("map.html", API_KEY=MAPBOX_API_KEY, name=nm, address=address, lat=lat, lon=lon,
+                           geojson_url=geojson_url)
 
 
+@timed("plot")
 def make_plot(xvals, yvals, texts, yaxis_name, plot_name):
     """
     Helper function for place_weather(.). Makes a line plot.
@@ -113,16 +528,14 @@ def make_plot(xvals, yvals, texts, yaxis_name, plot_name):
 
 @app.route("/<nm>/weather")
 def place_weather(nm):
-    map_place_default = "Ann Arbor"
-    tourist_site = load_from_db(nm)
+    tourist_site = load_from_db(nm, g.region.db_filename, g.region)
     lat, lon = tourist_site.lat, tourist_site.lon
 
     if lat is None or lon is None:
-        map_info_default = get_map_data(map_place_default, "cache_map.json")
-        lat, lon = map_info_default["lat"], map_info_default["lng"]
+        lat, lon = default_location()
 
     tourist_site.lat, tourist_site.lon = lat, lon
-    weather_data = tourist_site.get_weather("cache_weather.json")
+    weather_data = tourist_site.get_weather(g.region.cache_filename("weather"))
     # print(f"lat: {lat}, lon: {lon}")
     # pprint(weather_data)
     xvals = list(range(3, 3 * len(weather_data) + 3, 3))
@@ -135,5 +548,90 @@ def place_weather(nm):
     return render_template("weather.html", name=nm, weather_div=weather_div, wind_div=wind_div)
 
 
+@timed("plot")
+def make_multi_plot(xvals, traces, yaxis_name, plot_name, xaxis_name="date"):
+    """
+    Helper function for compare_weather(.). Makes a line plot with one line per named series, each with an optional
+    band between a lower and an upper bound.
+
+    Parameters
+    ----------
+    xvals: list
+        Shared x values.
+    traces: dict
+        In the form of {"series name": {"y": list, "y_min": list, "y_max": list}}; "y_min" and "y_max" are optional.
+    yaxis_name, plot_name, xaxis_name: str
+        Name of the figure.
+
+    Returns
+    -------
+    str
+        Figure in HTML.
+    """
+    data = []
+    for name, trace in traces.items():
+        error_y = None
+        if "y_min" in trace and "y_max" in trace:
+            y = np.array(trace["y"], dtype=np.float64)
+            error_y = {"type": "data", "symmetric": False,
+                       "array": (np.array(trace["y_max"], dtype=np.float64) - y).tolist(),
+                       "arrayminus": (y - np.array(trace["y_min"], dtype=np.float64)).tolist()}
+        data.append(go.Scatter(x=xvals, y=trace["y"],
+                               name=name,
+                               mode="lines+markers",
+                               error_y=error_y,
+                               marker={"symbol": "circle"},
+                               line={"width": 3}))
+    layout = {"title": {"text": f"{plot_name}", "x": 0.5},
+              "xaxis": {"title": f"{xaxis_name}"},
+              "yaxis": {"title": f"{yaxis_name}"}}
+    fig = go.Figure(data=data, layout=layout)
+    div = fig.to_html(full_html=False)
+
+    return div
+
+
+@app.route("/compare/weather")
+def compare_weather():
+    """
+    Daily weather comparison of the sites given as repeated "sites" query parameters. Forecasts are fetched
+    concurrently, once per weather grid cell. Append "format=json" for the raw daily statistics.
+    """
+    catalog = get_site_catalog(g.region.db_filename)
+    name_to_idx = catalog["index"]
+    names = list(dict.fromkeys(request.args.getlist("sites")))
+    missing = [name for name in names if name not in name_to_idx]
+    names = [name for name in names if name in name_to_idx]
+
+    cells = {name: weather_grid_cell(*catalog["coords"][name_to_idx[name]]) for name in names}
+    unique_cells = list(dict.fromkeys(cells.values()))
+    forecasts = dict()
+    if len(unique_cells) > 0:
+        with ThreadPoolExecutor(max_workers=min(8, len(unique_cells))) as executor:
+            cache_weather = g.region.cache_filename("weather")
+            results = timed_map(executor, lambda cell: get_weather_data(*cell, cache_weather), unique_cells)
+            forecasts = dict(zip(unique_cells, results))
+    daily = {name: get_daily_weather(forecasts[cells[name]]) for name in names}
+
+    if request.args.get("format") == "json":
+        return jsonify({"sites": daily, "missing": missing})
+
+    weather_div, wind_div = None, None
+    if len(daily) > 0:
+        # forecast horizons may differ by a day between grid cells; align all series on the union of dates
+        dates = sorted(set(date for summary in daily.values() for date in summary["date"]))
+        temp_traces, wind_traces = dict(), dict()
+        for name, summary in daily.items():
+            idx = {date: i for i, date in enumerate(summary["date"])}
+            pick = lambda key: [summary[key][idx[date]] if date in idx else None for date in dates]
+            temp_traces[name] = {"y": pick("temp_mean"), "y_min": pick("temp_min"), "y_max": pick("temp_max")}
+            wind_traces[name] = {"y": pick("wind_mean"), "y_min": pick("wind_min"), "y_max": pick("wind_max")}
+        weather_div = make_multi_plot(dates, temp_traces, "temperature in Celsius", "Daily Temperature (min / mean / max)")
+        wind_div = make_multi_plot(dates, wind_traces, "wind speed in m/s", "Daily Wind Speed (min / mean / max)")
+
+    return render_template("compare_weather.html", names=names, missing=missing, weather_div=weather_div,
+                           wind_div=wind_div)
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -5,9 +5,10 @@ import re
 from bs4 import BeautifulSoup
 from pprint import pprint
 from utilities import *
+from regions import default_region
 
 
-def scrape_main_page(cache_filename):
+def scrape_main_page(cache_filename, region=default_region):
     """
     Scrapes the main page for detailed pages' urls.
 
@@ -15,6 +16,8 @@ def scrape_main_page(cache_filename):
     ----------
     cache_filename: str
         Cache file to use. Don't scrape twice!
+    region: Region
+        Region whose main page to scrape.
 
     Returns
     -------
@@ -27,12 +30,12 @@ def scrape_main_page(cache_filename):
         print("fetching from cache...")
         return cache[key]
     print("making new request...")
-    main_url = "https://www.planetware.com/michigan-tourism-vacations-usmi.htm"
+    main_url = region.main_url
     base_url = "https://www.planetware.com"
     resp = requests.get(main_url)
     assert resp.status_code == 200, "GET failed"
     soup = BeautifulSoup(resp.text, "html.parser")
-    excluding_pattern = re.compile(r".*(tents|where to stay in detroit|michigan in pictures).*")
+    excluding_pattern = region.excluding_pattern
     detail_urls = {}
     dest_anchors = soup.select("div.dest a")
     for anchor in dest_anchors:
@@ -1,11 +1,65 @@
 # This file contains functions for common use
+import hashlib
 import json
+import os
+import re
 import sqlite3
+import stat
+import tempfile
+from contextlib import contextmanager
+from profiling import timed
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows: fall back to atomic rename only
+    fcntl = None
 
-def construct_unique_key(base_url, params, connector="_"):
+
+# credentials are never part of a cache key: rotating them must not invalidate caches, nor leak them into cache files
+secret_params = {"key", "apikey", "api_key", "access_token", "token", "secret"}
+
+# free-text location params, normalized so that e.g. " ann arbor" and "Ann Arbor, Michigan" share an entry
+location_params = {"location"}
+
+# longer keys are shortened to "base_url" + a hash of the params
+max_key_length = 200
+
+# mode of newly created cache files, as open(.) would create them; read once, since os.umask(.) can only be read by
+# setting it
+_umask = os.umask(0o022)
+os.umask(_umask)
+cache_file_mode = 0o666 & ~_umask
+
+
+def normalize_location(text, suffixes=()):
     """
-    Create a unique key for a query.
+    Normalizes free-text location for cache keys: case, whitespace and trailing ", <suffix>" parts, e.g. ", Michigan"
+    and ", MI" for suffixes ("Michigan", "MI").
+
+    Parameters
+    ----------
+    text: str
+        Location text.
+    suffixes: iterable
+        Names of the region searched in, which are implied and thus stripped, case-insensitively.
+
+    Returns
+    -------
+    str
+        Normalized location.
+    """
+    text = " ".join(str(text).lower().split())
+    suffixes = [re.escape(" ".join(suffix.lower().split())) for suffix in suffixes]
+    if len(suffixes) > 0:
+        text = re.sub(rf"(\s*,\s*({'|'.join(suffixes)}))+$", "", text)
+
+    return text.strip(" ,")
+
+
+def construct_unique_key(base_url, params, connector="_", location_suffixes=()):
+    """
+    Create a canonical key for a query: params are sorted, credentials (see "secret_params") are dropped, location
+    text is normalized (see normalize_location(.)) and keys longer than "max_key_length" are hashed.
 
     Parameters
     ----------
@@ -15,6 +69,8 @@ def construct_unique_key(base_url, params, connector="_"):
         Query parameters.
     connector: str
         Connecting symbol to string "base_url" and "params".
+    location_suffixes: iterable
+        Region names stripped from location text, e.g. the region's name and code.
 
     Returns
     -------
@@ -22,12 +78,101 @@ def construct_unique_key(base_url, params, connector="_"):
         The unique key as a str.
     """
     out_key = base_url
-    for key in params:
-        out_key += connector + f"{key}{connector}{params[key]}"
+    for key in sorted(params):
+        if key.lower() in secret_params:
+            continue
+        val = params[key]
+        if key in location_params:
+            val = normalize_location(val, location_suffixes)
+        out_key += connector + f"{key}{connector}{val}"
+
+    if len(out_key) > max_key_length:
+        digest = hashlib.sha1(out_key[len(base_url):].encode("utf-8")).hexdigest()
+        out_key = f"{base_url}{connector}sha1{connector}{digest}"
 
     return out_key
 
 
+def parse_legacy_key(old_key, legacy_params, connector="_"):
+    """
+    Parses a key made by the former construct_unique_key(.), which joined params in insertion order.
+
+    Parameters
+    ----------
+    old_key: str
+        The legacy key.
+    legacy_params: dict
+        In the form of {"base_url": ["param 1", "param 2", ...]}, the params of each endpoint in the order they
+        were inserted.
+    connector: str
+        Connecting symbol used in "old_key".
+
+    Returns
+    -------
+    tuple
+        (base_url, params), or None if "old_key" does not match any endpoint.
+    """
+    for base_url, names in legacy_params.items():
+        pattern = re.escape(base_url) + "".join(f"{re.escape(connector + name + connector)}(.*?)" for name in names)
+        match = re.fullmatch(pattern, old_key, flags=re.DOTALL)
+        if match is not None:
+            return base_url, dict(zip(names, match.groups()))
+
+    return None
+
+
+def rekey_cache(filename, legacy_params, connector="_", transform=None, location_suffixes=()):
+    """
+    Rewrites a cache file from legacy keys to canonical keys (see construct_unique_key(.)). Entries whose key is not
+    a legacy key are kept. When several entries map to the same canonical key, the first one is kept.
+
+    Parameters
+    ----------
+    filename: str
+        Cache file path.
+    legacy_params: dict
+        See parse_legacy_key(.).
+    connector: str
+        Connecting symbol of the keys.
+    transform: callable
+        Optional, maps (base_url, params) of a legacy key to the params of the current query.
+    location_suffixes: iterable
+        See construct_unique_key(.).
+
+    Returns
+    -------
+    dict
+        In the form of {"entries_before": int, "entries_after": int, "rekeyed": int, "redundant_ratio": float}.
+        "redundant_ratio" is the share of entries that repeat the query of another entry under canonical keys, i.e.
+        of cached upstream calls that canonical keys would have answered from the cache instead.
+    """
+    with cache_lock(filename):
+        cache = open_cache(filename)
+        new_cache = dict()
+        rekeyed = 0
+        for old_key, val in cache.items():
+            parsed = parse_legacy_key(old_key, legacy_params, connector)
+            if parsed is None:
+                new_key = old_key
+            else:
+                base_url, params = parsed
+                if transform is not None:
+                    params = transform(base_url, params)
+                new_key = construct_unique_key(base_url, params, connector=connector,
+                                               location_suffixes=location_suffixes)
+            rekeyed += new_key != old_key
+            if new_key not in new_cache:
+                new_cache[new_key] = val
+
+        write_cache_file(new_cache, filename)
+
+    redundant = len(cache) - len(new_cache)
+
+    return {"entries_before": len(cache), "entries_after": len(new_cache), "rekeyed": rekeyed,
+            "redundant_ratio": redundant / max(len(cache), 1)}
+
+
+@timed("cache")
 def open_cache(filename):
     """
     Open or create a cache.json file.
@@ -44,17 +189,49 @@ def open_cache(filename):
     """
     try:
         with open(filename, "r") as rf:
-            cache_dict = json.loads(rf.read())
-        return cache_dict
+            content = rf.read()
     except FileNotFoundError:
-        with open(filename, "w") as wf:
-            pass
         return {}
 
+    if content == "":
+        # left behind by older versions which created an empty file on first access
+        return {}
+
+    return json.loads(content)
 
+
+@contextmanager
+def cache_lock(filename):
+    """
+    Cross-process exclusive lock on a cache file, held on a sidecar "filename.lock" file. Serializes the
+    read-merge-write cycle in save_cache(.) between server workers. No-op where fcntl is unavailable.
+
+    Parameters
+    ----------
+    filename: str
+        Cache file path.
+
+    Returns
+    -------
+    None
+    """
+    if fcntl is None:
+        yield
+        return
+
+    with open(f"{filename}.lock", "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+@timed("cache")
 def save_cache(cache_dict, filename):
     """
-    Save the current cache dict to "filename".
+    Save the current cache dict to "filename". Entries written by other processes since "cache_dict" was loaded are
+    merged in rather than overwritten, and the file is replaced atomically so readers never see a partial write.
 
     Parameters
     ----------
@@ -67,10 +244,46 @@ def save_cache(cache_dict, filename):
     -------
     None
     """
-    with open(filename, "w") as wf:
-        wf.write(json.dumps(cache_dict))
+    with cache_lock(filename):
+        merged = open_cache(filename)
+        merged.update(cache_dict)
+        write_cache_file(merged, filename)
+
+
+def write_cache_file(cache_dict, filename):
+    """
+    Replaces "filename" with "cache_dict" atomically, via a temporary file and a rename. The file keeps its permission
+    bits, or gets those of open(.) if it is new. Call with cache_lock(.) held.
+
+    Parameters
+    ----------
+    cache_dict: dict
+        The cache dict to write.
+    filename: str
+        Cache file path.
+
+    Returns
+    -------
+    None
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except FileNotFoundError:
+        mode = cache_file_mode
+    fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix=f".{os.path.basename(filename)}.", suffix=".tmp")
+    try:
+        # mkstemp(.) creates the file owner-only
+        os.chmod(tmp_filename, mode)
+        with os.fdopen(fd, "w") as wf:
+            wf.write(json.dumps(cache_dict))
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
 
 
+@timed("db")
 def query(q, db):
     """
     Queries a database.
@@ -0,0 +1,199 @@
+# This file implements the cache warm-up job, see "python3 warm_cache.py --help"
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from classes import *
+from rate_limiter import background_priority, skipped_requests
+from regions import default_region, get_region
+
+
+def warm_site(name, region=default_region):
+    """
+    Fills the Twitter, map and weather caches for one site. Upstream calls run with background priority, so page
+    requests served at the same time keep their share of the rate limits.
+
+    Parameters
+    ----------
+    name: str
+        Place name.
+    region: Region
+        Region of the site, whose database and cache files are used.
+
+    Returns
+    -------
+    dict
+        Progress record in the form of {"status": "done" | "incomplete" | "failed", "time": float, "info": str},
+        where "incomplete" means some upstream calls were skipped for lack of rate limit budget.
+    """
+    skipped = []
+    token = skipped_requests.set(skipped)
+    try:
+        with background_priority():
+            tourist_site = load_from_db(name, region.db_filename, region)
+            tourist_site.get_twitter(region.cache_filename("twitter"))
+            tourist_site.get_map(region.cache_filename("map"))
+            tourist_site.get_weather(region.cache_filename("weather"))
+    except Exception as e:
+        return {"status": "failed", "time": time.time(), "info": repr(e)}
+    finally:
+        skipped_requests.reset(token)
+
+    if len(skipped) > 0:
+        return {"status": "incomplete", "time": time.time(), "info": f"rate limited: {', '.join(sorted(set(skipped)))}"}
+
+    return {"status": "done", "time": time.time(), "info": ""}
+
+
+def load_caches(region=default_region):
+    """
+    Loads the cache files of a region, as expected by data_api.missing_from_cache(.).
+
+    Parameters
+    ----------
+    region: Region
+        The region.
+
+    Returns
+    -------
+    dict
+        In the form of {"twitter": dict, "twitter_timeline": dict, "map": dict, "weather": dict}.
+    """
+    return {"twitter": open_cache(region.cache_filename("twitter")),
+            "twitter_timeline": open_cache(timeline_filename(region.cache_filename("twitter"))),
+            "map": open_cache(region.cache_filename("map")),
+            "weather": open_cache(region.cache_filename("weather"))}
+
+
+def missing_caches(names, region=default_region):
+    """
+    Checks the caches themselves (not the progress file, which survives a cache wipe) for the data of each site.
+
+    Parameters
+    ----------
+    names: list
+        Site names.
+    region: Region
+        Region of the sites.
+
+    Returns
+    -------
+    dict
+        In the form of {"site name": list}, the kinds of data missing for each site, see
+        data_api.missing_from_cache(.).
+    """
+    caches = load_caches(region)
+    output = dict()
+    for name in names:
+        tourist_site = load_from_db(name, region.db_filename, region)
+        place_name = tourist_site.address if tourist_site.address is not None else tourist_site.name
+        output[name] = missing_from_cache(name, place_name, tourist_site.lat, tourist_site.lon, caches, region)
+
+    return output
+
+
+def report(names, progress, region=default_region):
+    """
+    Prints how many sites have completely warmed caches.
+
+    Parameters
+    ----------
+    names: list
+        All site names.
+    progress: dict
+        Progress records by site name, see warm_site(.). Only used to explain why a site is not complete.
+    region: Region
+        Region of the sites.
+
+    Returns
+    -------
+    int
+        Number of sites with completely warmed caches.
+    """
+    missing = missing_caches(names, region)
+    counts = {"done": 0, "incomplete": 0, "failed": 0, "pending": 0}
+    statuses = dict()
+    for name in names:
+        if len(missing[name]) == 0:
+            statuses[name] = "done"
+        else:
+            # a "done" record left over from before a cache wipe means the site is pending again
+            status = progress.get(name, {"status": "pending"})["status"]
+            statuses[name] = "pending" if status == "done" else status
+        counts[statuses[name]] += 1
+
+    total = max(len(names), 1)
+    print(f"cache complete for {counts['done']} / {len(names)} sites ({100 * counts['done'] / total:.1f}%); "
+          f"incomplete: {counts['incomplete']}, failed: {counts['failed']}, pending: {counts['pending']}")
+    for name in names:
+        if statuses[name] != "done":
+            info = progress[name]["info"] if statuses[name] != "pending" else ""
+            print(f"  {statuses[name]}: {name} (missing: {', '.join(missing[name])}{'; ' + info if info else ''})")
+
+    return counts["done"]
+
+
+def warm_caches(region=default_region, workers=4, days=7, restart=False, progress_filename=None):
+    """
+    Fills the persistent caches of all sites of a region, most visited first, with at most "workers" sites in flight.
+    Sites whose caches are already complete are skipped, so an interrupted run resumes where it stopped. The outcome
+    of every site is saved to the progress file.
+
+    Parameters
+    ----------
+    region: Region
+        Region to warm.
+    workers: int
+        Number of sites warmed concurrently.
+    days: int
+        Popularity window, see classes.load_site_names_by_popularity(.).
+    restart: bool
+        Warm all sites again, even those with complete caches.
+    progress_filename: str
+        Progress file. Default: the region's "warm_progress" cache file.
+
+    Returns
+    -------
+    int
+        Number of sites with completely warmed caches.
+    """
+    if progress_filename is None:
+        progress_filename = region.cache_filename("warm_progress")
+    names = load_site_names_by_popularity(days, region.db_filename)
+    progress = dict() if restart else open_cache(progress_filename)
+    if restart:
+        todo = names
+    else:
+        missing = missing_caches(names, region)
+        todo = [name for name in names if len(missing[name]) > 0]
+    print(f"warming {len(todo)} of {len(names)} sites with {workers} workers...")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(warm_site, name, region): name for name in todo}
+        for i, future in enumerate(as_completed(futures)):
+            name = futures[future]
+            progress[name] = future.result()
+            # one entry per call: save_cache(.) merges entries, so concurrent runs don't drop each other's progress
+            save_cache({name: progress[name]}, progress_filename)
+            print(f"[{i + 1}/{len(todo)}] {progress[name]['status']}: {name}")
+
+    return report(names, progress, region)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Prefetch Twitter, map and weather data of all sites into the caches.")
+    parser.add_argument("--region", default=default_region.code, help="region code, e.g. MI")
+    parser.add_argument("--workers", type=int, default=4, help="number of sites warmed concurrently")
+    parser.add_argument("--days", type=int, default=7, help="rank sites by visits in the last DAYS days")
+    parser.add_argument("--restart", action="store_true", help="warm all sites again, even those with complete caches")
+    parser.add_argument("--report", action="store_true", help="only report cache completeness")
+    parser.add_argument("--progress", default=None, help="progress file (default: per region)")
+    args = parser.parse_args()
+
+    region = get_region(args.region)
+    if region is None:
+        parser.error(f"unknown region: {args.region}")
+    if args.report:
+        report(load_site_names_by_popularity(args.days, region.db_filename),
+               open_cache(args.progress or region.cache_filename("warm_progress")), region)
+    else:
+        warm_caches(region, args.workers, args.days, args.restart, args.progress)
@@ -0,0 +1,12 @@
+# This file is the WSGI entry point for multi-process serving, e.g. "gunicorn -c gunicorn.conf.py wsgi:app"
+from classes import init_region
+from regions import served_regions
+
+# with "preload_app" (see gunicorn.conf.py) this module runs once in the master process, before the workers fork
+for region in served_regions():
+    init_region(region)
+
+from router import app, load_region
+
+for region in served_regions():
+    load_region(region)